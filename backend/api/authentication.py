@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .response_cache import bump_version, get_version, local_copy_timeout
+
+
+User = get_user_model()
+
+
+def auth_namespace(user_id):
+    return f'auth:{user_id}'
+
+
+class TokenCache:
+    """Bounded, thread-safe LRU of token key -> (user, token).
+
+    Entries expire after a timeout and are checked against the user's
+    'auth:<id>' generation in the response cache. When that cache is
+    shared, a logout, password change or deactivation in one process is
+    seen by all; with a per-process cache other processes only notice
+    it once the short LOCAL_TIMEOUT runs out.
+    """
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, token, expires, version = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        if version != get_version(auth_namespace(user.pk)):
+            self.delete(key)
+            return None
+        # Views may modify request.user, every request gets its own copy.
+        return copy.copy(user), token
+
+    def set(self, key, user, token):
+        version = get_version(auth_namespace(user.pk))
+        with self._lock:
+            self._entries[key] = (user, token,
+                                  time.monotonic() + self.timeout, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+token_cache = TokenCache(
+    max_entries=settings.TOKEN_AUTH_CACHE['MAX_ENTRIES'],
+    timeout=local_copy_timeout(settings.TOKEN_AUTH_CACHE))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that skips the token and user query on a hit."""
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(key, user, token)
+        return copy.copy(user), token
+
+
+def invalidate_user_tokens(user_id):
+    bump_version(auth_namespace(user_id))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(instance, **kwargs):
+    # djoser's token/logout deletes the token.
+    token_cache.delete(instance.key)
+    transaction.on_commit(lambda: invalidate_user_tokens(instance.user_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(instance, **kwargs):
+    # Password changes and deactivation save the user.
+    transaction.on_commit(lambda: invalidate_user_tokens(instance.pk))
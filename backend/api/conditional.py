@@ -0,0 +1,84 @@
+from functools import wraps
+import hashlib
+
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from recipes.models import Favorite, Ingredient, ShoppingCart, Subscription
+
+
+RELATIONS = (
+    ('favorites', Favorite),
+    ('carts', ShoppingCart),
+    ('subscriptions', Subscription),
+)
+
+
+def ingredient_catalogue_version():
+    """Version of the ingredient catalogue, read from the data.
+
+    Row count and highest id catch additions and deletions, the latest
+    updated_at catches edits. Every process derives the same version.
+    """
+    stats = Ingredient.objects.aggregate(count=Count('id'), max_id=Max('id'),
+                                         updated_at=Max('updated_at'))
+    return stats['count'], stats['max_id'], stats['updated_at']
+
+
+def relation_version(user):
+    """Version of the favorites, cart and subscriptions of a user.
+
+    Each relation contributes its row count and highest id, all read in a
+    single query. Any addition raises the highest id, any removal lowers
+    the count.
+    """
+    if not user.is_authenticated:
+        return None
+    stats = {}
+    for name, model in RELATIONS:
+        rows = model.objects.filter(user=OuterRef('pk')).order_by().values(
+            'user')
+        stats[f'{name}_count'] = Subquery(
+            rows.annotate(value=Count('id')).values('value'))
+        stats[f'{name}_max_id'] = Subquery(
+            rows.annotate(value=Max('id')).values('value'))
+    return type(user).objects.filter(pk=user.pk).annotate(
+        **stats).values_list(*stats).first()
+
+
+def conditional_get(method):
+    """Answer If-None-Match with 304 before the response is built.
+
+    The view provides get_validators(), returning the parts the ETag is
+    derived from and the Last-Modified datetime (or None). The ETag also
+    covers the user, the path with its query and the renderer.
+    Last-Modified is sent as a hint only: a page also changes when rows
+    are deleted or relations toggled, which a timestamp cannot express,
+    so If-Modified-Since is not used to answer 304.
+    """
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        parts, last_modified = self.get_validators()
+        digest = hashlib.sha256(repr((
+            parts,
+            request.user.pk,
+            request.get_full_path(),
+            request.accepted_renderer.format,
+        )).encode()).hexdigest()
+        etag = f'W/"{digest[:32]}"'
+        headers = {'ETag': etag}
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified.timestamp())
+
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            for header, value in headers.items():
+                not_modified[header] = value
+            return not_modified
+
+        response = method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            for header, value in headers.items():
+                response[header] = value
+        return response
+    return wrapper
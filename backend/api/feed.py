@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from recipes.models import FeedEntry, Subscription
+
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def fan_out_authors(author_ids):
+    """Authors whose recipes are copied to the feeds of their followers."""
+    return list(User.objects.filter(
+        pk__in=author_ids,
+        follower_count__lt=settings.FEED['FANOUT_MAX_FOLLOWERS'],
+    ).values_list('id', flat=True))
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.FEED['FANOUT_WORKERS'],
+                thread_name_prefix='feed-fan-out')
+        return _executor
+
+
+def fan_out(recipe_id, author_id):
+    try:
+        if fan_out_authors([author_id]):
+            FeedEntry.objects.fan_out(recipe_id, author_id,
+                                      settings.FEED['BATCH_SIZE'])
+    except Exception:
+        # rebuild_feeds restores the entries.
+        logger.exception('Could not fan out recipe %s', recipe_id)
+
+
+def fan_out_in_background(recipe_id, author_id):
+    try:
+        fan_out(recipe_id, author_id)
+    finally:
+        connection.close()
+
+
+def recipe_created(recipe):
+    """Copy a new recipe to the followers' feeds once it is committed.
+
+    The batches are inserted by a background thread, so the request of
+    an author with many followers does not wait for them. Without
+    FANOUT_WORKERS they are inserted before the response.
+    """
+    def submit():
+        if settings.FEED['FANOUT_WORKERS']:
+            get_executor().submit(fan_out_in_background, recipe.pk,
+                                  recipe.author_id)
+        else:
+            fan_out(recipe.pk, recipe.author_id)
+
+    transaction.on_commit(submit)
+
+
+def subscribed(user, author_ids):
+    author_ids = fan_out_authors(author_ids)
+    if author_ids:
+        FeedEntry.objects.backfill(user.pk, author_ids,
+                                   settings.FEED['BACKFILL_LIMIT'])
+
+
+def unsubscribed(user, author_ids):
+    FeedEntry.objects.remove_authors(user.pk, author_ids)
+
+
+class MergedQuerySet:
+    """Querysets over the same model read as one, merged by UNION ALL.
+
+    Filters and ordering apply to every branch before the union is
+    built, so the branches keep using their own indexes, including the
+    keyset pagination filters. Provides what the read path and the
+    paginators use.
+    """
+
+    ordered = True
+
+    def __init__(self, querysets, ordering=('-id',)):
+        self.querysets = [queryset.order_by() for queryset in querysets]
+        self.model = self.querysets[0].model
+        self.ordering = ordering
+
+    def _chain(self, method, *args, **kwargs):
+        return MergedQuerySet(
+            [getattr(queryset, method)(*args, **kwargs)
+             for queryset in self.querysets], self.ordering)
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', *args, **kwargs)
+
+    def prefetch_related(self, *lookups):
+        return self._chain('prefetch_related', *lookups)
+
+    def values(self, *fields):
+        return self._chain('values', *fields)
+
+    def order_by(self, *ordering):
+        return MergedQuerySet(self.querysets, ordering)
+
+    def union(self):
+        first, *rest = self.querysets
+        return first.union(*rest, all=True).order_by(*self.ordering)
+
+    def count(self):
+        return self.union().count()
+
+    def __getitem__(self, key):
+        return self.union()[key]
+
+    def __iter__(self):
+        return iter(self.union())
+
+
+def feed_queryset(queryset, user):
+    """Recipes of the authors a user follows, newest first.
+
+    Fanned out recipes are joined from the user's FeedEntry rows, whose
+    (user, recipe) index yields them by descending recipe id. Recipes of
+    authors with too many followers to fan out are read by author, and
+    both are merged with UNION ALL.
+    """
+    pulled_authors = Subscription.objects.filter(
+        user=user,
+        author__follower_count__gte=settings.FEED['FANOUT_MAX_FOLLOWERS'],
+    ).values('author_id')
+    return MergedQuerySet([
+        queryset.filter(feed_entries__user=user),
+        # Entries fanned out before the author got too many followers
+        # are already in the first branch.
+        queryset.filter(author_id__in=pulled_authors).exclude(
+            feed_entries__user=user),
+    ])
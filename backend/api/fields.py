@@ -1,28 +1,49 @@
 from drf_extra_fields.fields import Base64ImageField
-from django.core.files.base import ContentFile
-import base64
-import uuid
 from rest_framework import serializers
+from .images import (PENDING_KEY, VARIANT_WIDTHS, PendingImage,
+                     sniff_format, source_digest, variants_field_name,
+                     verify_image)
+from django.core.files.storage import default_storage
 
 
 class Base64ToImageField(Base64ImageField):
+    """Base64 image field that hands re-encoding over to the image pipeline.
+
+    The image is verified here, so a broken upload is a validation error;
+    resizing and re-encoding happen in a worker process once the instance
+    is saved, see api.images. Resubmitting the stored image leaves the
+    field out of validated_data, so it is neither processed nor written
+    again.
+    """
+
     def to_internal_value(self, data):
         if not data:
             return None
 
-        try:
-            if isinstance(data, str) and data.startswith('data:'):
-                decoded_file = base64.b64decode(data.split(',')[1])
-                file_name = str(uuid.uuid4())[:12]
-                complete_file_name = f'{file_name}.jpg'
-                data = ContentFile(decoded_file, name=complete_file_name)
-            return data
-        except TypeError as e:
-            print(f'TypeError: {e}')
-            self.fail('invalid_image')
-        except Exception as e:
-            print(f'Error: {e}')
-            self.fail('invalid_image')
+        if isinstance(data, str) and data.startswith('data:'):
+            header, _, encoded = data.partition(',')
+            if (not header.startswith('data:image/')
+                    or sniff_format(encoded) is None):
+                self.fail('invalid_image')
+            try:
+                verify_image(encoded)
+            except Exception:  # Pillow raises many types for broken files.
+                self.fail('invalid_image')
+            if self.is_stored(encoded):
+                raise serializers.SkipField()
+            return PendingImage(encoded)
+        return data
+
+    def is_stored(self, encoded):
+        instance = getattr(self.parent, 'instance', None)
+        if instance is None:
+            return False
+        variants_field = variants_field_name(type(instance), self.source)
+        if variants_field is None:
+            return False
+        variants = getattr(instance, variants_field) or {}
+        return (PENDING_KEY not in variants
+                and variants.get('source') == source_digest(encoded))
 
 
 class Base64RequiredImageField(Base64ToImageField):
@@ -30,3 +51,48 @@ class Base64RequiredImageField(Base64ToImageField):
         if not data:
             raise serializers.ValidationError('Это поле обязательно')
         return super().to_internal_value(data)
+
+
+def file_url(name, request=None):
+    """Absolute URL of a stored file, as serializers.FileField renders it."""
+    if not name:
+        return None
+    url = default_storage.url(name)
+    return request.build_absolute_uri(url) if request else url
+
+
+def image_variants_representation(variants, request=None):
+    """Absolute URLs of the resized variants plus ready-made srcsets."""
+    representation = {}
+    srcset = {'webp': [], 'jpeg': []}
+    widths = set()
+    for variant in VARIANT_WIDTHS:
+        if variant not in variants:
+            continue
+        stored = variants[variant]
+        representation[variant] = {
+            'width': stored['width'],
+            'height': stored['height'],
+            'webp': file_url(stored['webp'], request),
+            'jpeg': file_url(stored['jpeg'], request),
+        }
+        if stored['width'] in widths:
+            continue
+        widths.add(stored['width'])
+        for image_format, sources in srcset.items():
+            sources.append(f'{representation[variant][image_format]} '
+                           f'{stored["width"]}w')
+    if representation:
+        representation['srcset'] = {
+            image_format: ', '.join(sources)
+            for image_format, sources in srcset.items()
+        }
+    if 'placeholder' in variants:
+        representation['placeholder'] = variants['placeholder']
+    return representation
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    def to_representation(self, variants):
+        return image_variants_representation(variants,
+                                             self.context.get('request'))
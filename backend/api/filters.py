@@ -0,0 +1,33 @@
+from django_filters import rest_framework as filters
+from recipes.models import Recipe
+
+from .ingredient_recipes import recipes_with_all, recipes_with_any
+
+
+class NumberInFilter(filters.BaseInFilter, filters.NumberFilter):
+    pass
+
+
+class RecipeFilter(filters.FilterSet):
+    """Recipe filters; ingredient ids are passed comma separated."""
+
+    ingredients = NumberInFilter(method='filter_ingredients')
+    exclude_ingredients = NumberInFilter(method='filter_exclude_ingredients')
+    cooking_time_min = filters.NumberFilter(field_name='cooking_time',
+                                            lookup_expr='gte')
+    cooking_time_max = filters.NumberFilter(field_name='cooking_time',
+                                            lookup_expr='lte')
+
+    class Meta:
+        model = Recipe
+        fields = ['author']
+
+    def filter_ingredients(self, queryset, name, value):
+        if not value:
+            return queryset
+        return queryset.filter(pk__in=recipes_with_all(set(map(int, value))))
+
+    def filter_exclude_ingredients(self, queryset, name, value):
+        if not value:
+            return queryset
+        return queryset.exclude(pk__in=recipes_with_any(set(map(int, value))))
@@ -0,0 +1,431 @@
+import base64
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import io
+import logging
+import multiprocessing
+import posixpath
+import threading
+import uuid
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image, ImageFilter, ImageOps
+
+from .response_cache import invalidate_model
+
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_NAME = 'placeholders/processing.png'
+OUTPUT_FORMATS = {
+    'JPEG': ('JPEG', 'jpg'),
+    'PNG': ('PNG', 'png'),
+    'WEBP': ('WEBP', 'webp'),
+}
+DEFAULT_OUTPUT_FORMAT = ('PNG', 'png')
+VARIANT_WIDTHS = {
+    'thumb': 160,
+    'card': 480,
+    'full': 1200,
+}
+PLACEHOLDER_SIZE = 16
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'RIFF', 'WEBP'),
+)
+
+
+def sniff_format(encoded):
+    """Guess the image format from the first bytes of base64 data."""
+    try:
+        head = base64.b64decode(encoded[:16], validate=True)
+    except ValueError:
+        return None
+    for signature, image_format in SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    return None
+
+
+def verify_image(encoded):
+    """Check that base64 data decodes to an image Pillow can read.
+
+    Only the headers and the file structure are checked, the pixels are
+    decoded later by process_image(). Raises on invalid data.
+    """
+    raw = base64.b64decode(encoded, validate=True)
+    with Image.open(io.BytesIO(raw)) as image:
+        image.verify()
+
+
+def source_digest(encoded):
+    """Digest of a submitted base64 payload, kept with the variants."""
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def to_rgb(image):
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def encode(image, image_format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def make_variants(image):
+    """Render the fixed-width variants and the blurred placeholder.
+
+    Variants are never upscaled; each one is encoded as WebP with a JPEG
+    fallback.
+    """
+    image = to_rgb(image)
+    variants = {}
+    for variant, width in VARIANT_WIDTHS.items():
+        resized = image
+        if image.width > width:
+            resized = image.resize(
+                (width, max(round(image.height * width / image.width), 1)),
+                Image.LANCZOS)
+        variants[variant] = {
+            'width': resized.width,
+            'height': resized.height,
+            'webp': encode(resized, 'WEBP', quality=80),
+            'jpeg': encode(resized, 'JPEG', quality=82, progressive=True),
+        }
+    tiny = image.copy()
+    tiny.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    tiny = tiny.filter(ImageFilter.GaussianBlur(1))
+    placeholder = base64.b64encode(encode(tiny, 'JPEG', quality=50)).decode()
+    return variants, f'data:image/jpeg;base64,{placeholder}'
+
+
+def process_image(encoded):
+    """Decode, verify and normalise a base64 encoded image.
+
+    Runs in a worker process. Returns the re-encoded original with the
+    file extension of the detected format, plus its variants; the EXIF
+    orientation is applied to the pixels and the rest of the metadata is
+    dropped.
+    """
+    raw = base64.b64decode(encoded, validate=True)
+    with Image.open(io.BytesIO(raw)) as image:
+        image.verify()
+
+    image = Image.open(io.BytesIO(raw))
+    output_format, extension = OUTPUT_FORMATS.get(image.format,
+                                                  DEFAULT_OUTPUT_FORMAT)
+    image = ImageOps.exif_transpose(image)
+    if output_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    variants, placeholder = make_variants(image)
+    return {
+        'content': encode(image, output_format, optimize=True),
+        'extension': extension,
+        'variants': variants,
+        'placeholder': placeholder,
+        'source': source_digest(encoded),
+    }
+
+
+def process_stored_image(raw):
+    """Build variants for an already stored image (backfill)."""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(raw)))
+    variants, placeholder = make_variants(image)
+    return {'variants': variants, 'placeholder': placeholder}
+
+
+def run_in_worker(function, *args):
+    try:
+        return function(*args)
+    finally:
+        connections.close_all()
+
+
+class ImagePipeline:
+    """Bounded process pool for image ingestion.
+
+    At most queue_size images are queued or in progress; past that (and
+    with workers=0) images are processed in the calling thread. Workers
+    set Django up, so tasks may use the ORM and the storage.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=django.setup)
+            return self._executor
+
+    def discard_executor(self, executor):
+        """Drop a broken pool, the next submit starts a new one."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, function, *args):
+        if self.workers and self._slots.acquire(blocking=False):
+            executor = self.get_executor()
+            try:
+                future = executor.submit(run_in_worker, function, *args)
+            except Exception:
+                # A worker died, e.g. killed for running out of memory.
+                logger.warning('Image worker pool is broken, replacing it',
+                               exc_info=True)
+                self._slots.release()
+                self.discard_executor(executor)
+            else:
+                future.add_done_callback(
+                    lambda done: self.task_done(executor, done))
+                return future
+
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def task_done(self, executor, future):
+        self._slots.release()
+        if (not future.cancelled()
+                and isinstance(future.exception(), BrokenProcessPool)):
+            self.discard_executor(executor)
+
+
+image_pipeline = ImagePipeline(
+    workers=settings.IMAGE_PROCESSING['WORKERS'],
+    queue_size=settings.IMAGE_PROCESSING['QUEUE_SIZE'])
+
+PENDING_KEY = 'pending'
+
+
+def get_placeholder():
+    if not default_storage.exists(PLACEHOLDER_NAME):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1, 1), (238, 238, 238)).save(buffer, 'PNG')
+        default_storage.save(PLACEHOLDER_NAME, ContentFile(buffer.getvalue()))
+    return PLACEHOLDER_NAME
+
+
+def is_placeholder(file):
+    return bool(file) and file.name == PLACEHOLDER_NAME
+
+
+class PendingImage:
+    """A verified upload, processed and stored after the instance is saved.
+
+    The token is kept under 'pending' in the variants field, so only the
+    latest upload for a field is stored.
+    """
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.token = uuid.uuid4().hex
+        self.future = None
+
+    def finalize(self, instance, field_name):
+        model = type(instance)
+
+        def submit():
+            # Runs after the commit, an error here would turn the saved
+            # instance into a 500 response.
+            try:
+                self.future = image_pipeline.submit(
+                    ingest_image, instance._meta.label, instance.pk,
+                    field_name, self.token, self.encoded)
+            except Exception as error:
+                self.future = Future()
+                self.future.set_exception(error)
+            self.future.add_done_callback(log_failure)
+            self.future.add_done_callback(
+                lambda future: invalidate_when_stored(model, future))
+
+        transaction.on_commit(submit)
+
+    def wait(self):
+        """Wait until a submitted image is stored, True on success."""
+        if self.future is None:
+            return False
+        try:
+            return self.future.result()
+        except Exception:
+            return False
+
+
+def log_failure(future):
+    if future.exception() is not None:
+        logger.error('Could not store image', exc_info=future.exception())
+
+
+def invalidate_when_stored(model, future):
+    # The save in a worker process only reaches that process's cache.
+    if future.exception() is None and future.result():
+        invalidate_model(model)
+
+
+def variants_field_name(model, field_name):
+    """Name of the JSON field holding the variants of an image field."""
+    name = f'{field_name}_variants'
+    try:
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    return name
+
+
+def save_variants(file, processed):
+    """Store the variant files next to the original and describe them."""
+    stem, _ = posixpath.splitext(file.name)
+    variants = {}
+    for variant, rendered in processed['variants'].items():
+        variants[variant] = {
+            'width': rendered['width'],
+            'height': rendered['height'],
+            'webp': file.storage.save(f'{stem}_{variant}.webp',
+                                      ContentFile(rendered['webp'])),
+            'jpeg': file.storage.save(f'{stem}_{variant}.jpg',
+                                      ContentFile(rendered['jpeg'])),
+        }
+    variants['placeholder'] = processed['placeholder']
+    if 'source' in processed:
+        variants['source'] = processed['source']
+    return variants
+
+
+def is_latest_upload(instance, variants_field, token):
+    if variants_field is None:
+        return True
+    variants = getattr(instance, variants_field) or {}
+    return variants.get(PENDING_KEY) == token
+
+
+def ingest_image(model_label, pk, field_name, token, encoded):
+    """Process an upload and store it in place of the current image.
+
+    Runs in a worker process. The files are written first and swapped in
+    under a row lock, unless a newer upload replaced this one meanwhile;
+    until then the instance keeps its previous image.
+    """
+    model = apps.get_model(model_label)
+    variants_field = variants_field_name(model, field_name)
+    instance = model._base_manager.filter(pk=pk).first()
+    if instance is None or not is_latest_upload(instance, variants_field,
+                                                token):
+        return False
+    try:
+        processed = process_image(encoded)
+    except Exception:
+        logger.exception('Could not process image for %s %s.%s',
+                         model_label, pk, field_name)
+        return False
+
+    file = getattr(instance, field_name)
+    file.save(f'{str(uuid.uuid4())[:12]}.{processed["extension"]}',
+              ContentFile(processed['content']),
+              save=False)
+    variants = save_variants(file, processed) if variants_field else None
+    with transaction.atomic():
+        current = model._base_manager.select_for_update().filter(
+            pk=pk).first()
+        if current is None or not is_latest_upload(current, variants_field,
+                                                   token):
+            delete_files(file, variants)
+            return False
+        setattr(current, field_name, file.name)
+        update_fields = [field_name]
+        if variants_field:
+            setattr(current, variants_field, variants)
+            update_fields.append(variants_field)
+        if 'updated_at' in {field.name
+                            for field in model._meta.concrete_fields}:
+            update_fields.append('updated_at')
+        current.save(update_fields=update_fields)
+    return True
+
+
+def delete_files(file, variants):
+    """Remove an image stored for an upload that was superseded."""
+    names = [file.name]
+    for variant in VARIANT_WIDTHS:
+        if variants and variant in variants:
+            names += [variants[variant]['webp'], variants[variant]['jpeg']]
+    for name in names:
+        file.storage.delete(name)
+
+
+class PendingImageSerializerMixin:
+    """Hand uploaded images over to the image pipeline after saving.
+
+    Until an image is stored, new instances show a placeholder and
+    existing ones keep their previous image. With wait_for_images the
+    serializer waits for the pipeline, so the response has the new image.
+    """
+
+    wait_for_images = False
+
+    def _pop_pending_images(self, validated_data, instance=None):
+        pending = {}
+        for field_name, value in validated_data.items():
+            if isinstance(value, PendingImage):
+                pending[field_name] = value
+        for field_name, image in pending.items():
+            current = getattr(instance, field_name, None)
+            if current:
+                del validated_data[field_name]
+            else:
+                validated_data[field_name] = get_placeholder()
+            variants_field = variants_field_name(self.Meta.model, field_name)
+            if variants_field:
+                variants = getattr(instance, variants_field, None) or {}
+                if not current:
+                    variants = {}
+                validated_data[variants_field] = dict(
+                    variants, **{PENDING_KEY: image.token})
+        return pending
+
+    def _finalize(self, instance, pending):
+        for field_name, image in pending.items():
+            image.finalize(instance, field_name)
+        if self.wait_for_images and pending:
+            if all([image.wait() for image in pending.values()]):
+                instance.refresh_from_db(fields=[
+                    name for field_name in pending
+                    for name in (field_name, variants_field_name(
+                        type(instance), field_name)) if name])
+
+    def create(self, validated_data):
+        pending = self._pop_pending_images(validated_data)
+        instance = super().create(validated_data)
+        self._finalize(instance, pending)
+        return instance
+
+    def update(self, instance, validated_data):
+        pending = self._pop_pending_images(validated_data, instance)
+        instance = super().update(instance, validated_data)
+        self._finalize(instance, pending)
+        return instance
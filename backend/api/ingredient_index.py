@@ -0,0 +1,94 @@
+from bisect import bisect_left
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from recipes.models import Ingredient
+
+
+class IngredientPrefixIndex:
+    """Process-local index of ingredients sorted by casefolded name.
+
+    A prefix lookup is two bisections over the sorted keys. Searches may
+    pass the current catalogue version, see
+    api.conditional.ingredient_catalogue_version; the index is rebuilt
+    when it differs from the one it was built at.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = ([], [])
+        self._built_at = None
+        self._version = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(name):
+        return name.casefold()
+
+    def is_stale(self, version=None):
+        if self._built_at is None:
+            return True
+        if version is not None and version != self._version:
+            return True
+        return (self.ttl is not None
+                and time.monotonic() - self._built_at > self.ttl)
+
+    def invalidate(self):
+        self._generation += 1
+        self._built_at = None
+
+    def rebuild(self, version=None):
+        generation = self._generation
+        built_at = time.monotonic()
+        ingredients = sorted(
+            Ingredient.objects.only('id', 'name', 'measurement_unit'),
+            key=lambda ingredient: (self.normalize(ingredient.name),
+                                    ingredient.measurement_unit))
+        self._entries = (
+            [self.normalize(ingredient.name) for ingredient in ingredients],
+            ingredients)
+        if generation == self._generation:
+            self._built_at = built_at
+            self._version = version
+
+    def search(self, prefix='', limit=None, version=None):
+        """Return ingredients whose name starts with prefix.
+
+        Returns None when the index is stale and cannot be rebuilt right
+        now (another thread is rebuilding it or the database is down).
+        """
+        if self.is_stale(version):
+            if not self._lock.acquire(blocking=False):
+                return None
+            try:
+                if self.is_stale(version):
+                    self.rebuild(version)
+            except DatabaseError:
+                return None
+            finally:
+                self._lock.release()
+
+        keys, ingredients = self._entries
+        if not prefix:
+            return ingredients[:limit]
+        prefix = self.normalize(prefix)
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\U0010ffff', lo=start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return ingredients[start:end]
+
+
+ingredient_index = IngredientPrefixIndex(
+    ttl=getattr(settings, 'INGREDIENT_INDEX_TTL', None))
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_ingredient_index(**kwargs):
+    ingredient_index.invalidate()
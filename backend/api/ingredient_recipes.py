@@ -0,0 +1,188 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+from recipes.models import IngredientInRecipe, Recipe
+
+from .relation_sets import MAX_IDS_IN_QUERY, RelationSet
+
+
+# Past this many changed recipes the index is rebuilt instead.
+MAX_CATCH_UP_RECIPES = 500
+
+
+def latest_recipe_change():
+    """(updated_at, id) of the last saved recipe, None without recipes."""
+    return Recipe.objects.order_by('-updated_at', '-id').values_list(
+        'updated_at', 'id').first()
+
+
+def recipes_changed_since(stamp):
+    recipes = Recipe.objects.order_by()
+    if stamp is not None:
+        updated_at, recipe_id = stamp
+        recipes = recipes.filter(updated_at__gte=updated_at).exclude(
+            updated_at=updated_at, id__lte=recipe_id)
+    return recipes
+
+
+def intersect(recipe_sets, limit):
+    recipe_sets = sorted(recipe_sets, key=len)
+    if len(recipe_sets[0]) > limit:
+        return None
+    recipe_ids = set(recipe_sets[0])
+    for recipe_set in recipe_sets[1:]:
+        if not recipe_ids:
+            break
+        recipe_ids = {recipe_id for recipe_id in recipe_ids
+                      if recipe_id in recipe_set}
+    return recipe_ids
+
+
+def unite(recipe_sets, limit):
+    recipe_ids = set()
+    for recipe_set in recipe_sets:
+        recipe_ids.update(recipe_set)
+        if len(recipe_ids) > limit:
+            return None
+    return recipe_ids
+
+
+class IngredientRecipeIndex:
+    """Process-local ingredient -> sorted recipe ids.
+
+    Memory follows the number of recipe ingredients, and "all of" and
+    "none of" queries become set operations on the ids of a few
+    ingredients. Recipe.updated_at, which every recipe and recipe
+    ingredient edit touches, is the shared version: recipes saved after
+    the last seen (updated_at, id) are re-read and their ids replaced.
+    The index is built in a background thread, at first use and then
+    every `ttl` seconds; until the first build has finished, the filters
+    are answered by the database. Rebuilds drop deleted recipes (harmless
+    meanwhile, their ids match no rows) and pick up anything written
+    without saving the recipe or committed after a later save.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._recipes = None
+        self._stamp = None
+        self._built_at = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def claim_build(self):
+        with self._lock:
+            if self._building:
+                return False
+            self._building = True
+            return True
+
+    def build(self):
+        """Read the whole index, unless another thread is building it."""
+        if self.claim_build():
+            self.run_build()
+
+    def build_in_background(self):
+        if self.claim_build():
+            threading.Thread(target=self.run_build,
+                             kwargs={'background': True},
+                             daemon=True).start()
+
+    def run_build(self, background=False):
+        try:
+            stamp = latest_recipe_change()
+            recipes = {}
+            rows = IngredientInRecipe.objects.values_list(
+                'ingredient_id', 'recipe_id').order_by()
+            for ingredient_id, recipe_id in rows.iterator():
+                recipes.setdefault(ingredient_id, []).append(recipe_id)
+            recipes = {ingredient_id: RelationSet(recipe_ids)
+                       for ingredient_id, recipe_ids in recipes.items()}
+            with self._lock:
+                self._recipes, self._stamp = recipes, stamp
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._building = False
+            if background:
+                connection.close()
+
+    def catch_up(self):
+        """Replace the ids of recipes saved since the last check.
+
+        Returns False when the index has to be rebuilt instead.
+        """
+        changes = list(recipes_changed_since(self._stamp).order_by(
+            'updated_at', 'id').values_list('updated_at', 'id')[
+                :MAX_CATCH_UP_RECIPES + 1])
+        if not changes:
+            return True
+        if len(changes) > MAX_CATCH_UP_RECIPES:
+            return False
+        recipe_ids = [recipe_id for _, recipe_id in changes]
+        rows = IngredientInRecipe.objects.filter(
+            recipe_id__in=recipe_ids).values_list('ingredient_id',
+                                                  'recipe_id')
+        for recipe_set in self._recipes.values():
+            recipe_set.discard(recipe_ids)
+        for ingredient_id, recipe_id in rows:
+            self._recipes.setdefault(ingredient_id, RelationSet()).add(
+                [recipe_id])
+        self._stamp = changes[-1]
+        return True
+
+    def lookup(self, ingredient_ids, combine, limit):
+        """Combine the recipe ids of the ingredients.
+
+        None while the index is unavailable or when the result would
+        exceed limit.
+        """
+        if self._built_at is None or (
+                time.monotonic() - self._built_at > self.ttl):
+            self.build_in_background()
+        with self._lock:
+            if self._recipes is None:
+                return None
+            if self.catch_up():
+                return combine([self._recipes.get(ingredient_id, ())
+                                for ingredient_id in ingredient_ids], limit)
+            # Left to the database until the rebuild has finished.
+            self._recipes = None
+        self.build_in_background()
+        return None
+
+    def all_of(self, ingredient_ids, limit=MAX_IDS_IN_QUERY):
+        """Ids of recipes using every ingredient, None if unavailable."""
+        return self.lookup(ingredient_ids, intersect, limit)
+
+    def any_of(self, ingredient_ids, limit=MAX_IDS_IN_QUERY):
+        """Ids of recipes using any ingredient, None if unavailable."""
+        return self.lookup(ingredient_ids, unite, limit)
+
+
+ingredient_recipe_index = IngredientRecipeIndex(
+    ttl=settings.INGREDIENT_RECIPES_TTL)
+
+
+def recipes_with_all(ingredient_ids):
+    """Recipe ids (or a subquery) of recipes using all the ingredients."""
+    recipe_ids = ingredient_recipe_index.all_of(ingredient_ids)
+    if recipe_ids is not None:
+        return sorted(recipe_ids)
+    return IngredientInRecipe.objects.filter(
+        ingredient_id__in=ingredient_ids
+    ).order_by().values('recipe_id').annotate(
+        matched=Count('ingredient_id')
+    ).filter(matched=len(ingredient_ids)).values('recipe_id')
+
+
+def recipes_with_any(ingredient_ids):
+    """Recipe ids (or a subquery) of recipes using any of the ingredients."""
+    recipe_ids = ingredient_recipe_index.any_of(ingredient_ids)
+    if recipe_ids is not None:
+        return sorted(recipe_ids)
+    return IngredientInRecipe.objects.filter(
+        ingredient_id__in=ingredient_ids).values('recipe_id')
@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from recipes.models import Ingredient, Recipe, User
+from rest_framework.test import APIClient
+
+from ...query_plans import check_endpoint, endpoints, large_tables
+
+
+class Command(BaseCommand):
+    help = ('Runs the main API endpoints against the current (seeded) '
+            'database and fails if their queries sequentially scan '
+            'large tables')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-rows',
+            type=int,
+            default=10000,
+            help='Tables with fewer rows may be scanned sequentially',
+        )
+        parser.add_argument(
+            '--verbose-plans',
+            action='store_true',
+            help='Print every captured query with its plan',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Query plans can only be checked on PostgreSQL')
+
+        tables = large_tables(options['min_rows'])
+        user = (User.objects.filter(shopping_carts__isnull=False).first()
+                or User.objects.first())
+        recipe = Recipe.objects.select_related('author').first()
+        ingredient = Ingredient.objects.first()
+        if user is None or recipe is None or ingredient is None:
+            raise CommandError('Seed the database before checking plans')
+
+        client = APIClient()
+        client.force_authenticate(user)
+        failures = []
+        for name, url in endpoints(recipe, recipe.author, ingredient):
+            response, plans, scanned = check_endpoint(client, url, tables)
+            if options['verbose_plans']:
+                for sql, plan in plans:
+                    self.stdout.write(f'{sql}\n{json.dumps(plan, indent=2)}')
+            status = response.status_code
+            if scanned:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(
+                    f'{name} ({status}, {len(plans)} queries): '
+                    f'sequential scan on {", ".join(sorted(scanned))}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    f'{name} ({status}, {len(plans)} queries): ok'))
+
+        if failures:
+            raise CommandError(
+                f'Sequential scans on large tables in: {", ".join(failures)}')
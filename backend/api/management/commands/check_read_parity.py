@@ -0,0 +1,107 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import RequestFactory
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from ...readers import build_recipes, build_users, recipe_values, user_values
+from ...relation_sets import relation_sets
+from ...renderers import ORJSONRenderer
+from ...serializers import RecipeSerializer, UserSerializer
+from ...views import RecipeViewSet, UserViewSet
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ('Checks that the fast read path renders recipes and users '
+            'byte for byte like the serializers')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default='localhost',
+            help='Host the absolute image URLs are built for',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=200,
+            help='Recipes and users compared per viewer',
+        )
+        parser.add_argument(
+            '--viewers',
+            type=int,
+            default=5,
+            help='Users with the most relations to compare as, besides '
+                 'the anonymous user',
+        )
+
+    def handle(self, *args, **options):
+        viewers = [AnonymousUser()] + list(User.objects.annotate(
+            relations=Count('favorites', distinct=True)
+            + Count('shopping_carts', distinct=True)
+            + Count('subscriptions', distinct=True),
+        ).order_by('-relations', 'id')[:options['viewers']])
+
+        mismatches = 0
+        for viewer in viewers:
+            request = Request(RequestFactory().get(
+                '/api/recipes/', HTTP_HOST=options['host']))
+            request.user = viewer
+            name = viewer.get_username() or 'anonymous'
+            relations = relation_sets.get(viewer)
+
+            recipes = self.get_queryset(RecipeViewSet, request, 'list')
+            recipes = recipes[:options['limit']]
+            mismatches += self.compare(
+                f'recipes as {name}',
+                RecipeSerializer(recipes, many=True,
+                                 context={'request': request}).data,
+                build_recipes(recipe_values(recipes), request, relations))
+
+            # Non-staff users only see themselves in the djoser list.
+            users = self.get_queryset(UserViewSet, request, 'retrieve')
+            users = users[:options['limit']]
+            mismatches += self.compare(
+                f'users as {name}',
+                UserSerializer(users, many=True,
+                               context={'request': request}).data,
+                build_users(user_values(users), request, relations))
+
+        if mismatches:
+            raise CommandError(f'{mismatches} objects differ')
+        self.stdout.write(self.style.SUCCESS(
+            f'Fast read path matches the serializers for '
+            f'{len(viewers)} viewers'))
+
+    @staticmethod
+    def get_queryset(viewset, request, action):
+        view = viewset(request=request, action=action, args=(), kwargs={},
+                       format_kwarg=None)
+        return view.get_queryset()
+
+    def compare(self, label, expected, actual):
+        renderer = JSONRenderer()
+        expected = [renderer.render(item) for item in expected]
+        mismatches = 0
+        for name, rendered in (
+                ('rows', [renderer.render(item) for item in actual]),
+                ('orjson', [ORJSONRenderer().render(item)
+                            for item in actual])):
+            if len(rendered) != len(expected):
+                self.stderr.write(f'{label} ({name}): {len(rendered)} '
+                                  f'objects instead of {len(expected)}')
+                mismatches += 1
+                continue
+            for serialized, built in zip(expected, rendered):
+                if serialized != built:
+                    mismatches += 1
+                    self.stderr.write(f'{label} ({name}):\n'
+                                      f'  serializer: {serialized!r}\n'
+                                      f'  fast path:  {built!r}')
+        self.stdout.write(f'{label}: {len(expected)} objects compared')
+        return mismatches
@@ -0,0 +1,72 @@
+from collections import deque
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from recipes.models import Recipe
+
+from ...images import (PLACEHOLDER_NAME, image_pipeline,
+                       process_stored_image, save_variants)
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Generates resized variants for already uploaded images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Regenerate variants that already exist',
+        )
+
+    def handle(self, *args, **options):
+        for model, field_name in ((Recipe, 'image'), (User, 'avatar')):
+            variants_field = f'{field_name}_variants'
+            queryset = model.objects.exclude(
+                Q(**{field_name: ''})
+                | Q(**{f'{field_name}__isnull': True})
+                | Q(**{field_name: PLACEHOLDER_NAME}))
+            if not options['force']:
+                queryset = queryset.filter(**{variants_field: {}})
+            generated = self.backfill(queryset.only('pk', field_name),
+                                      field_name, variants_field)
+            self.stdout.write(self.style.SUCCESS(
+                f'Generated variants for {generated} '
+                f'{model._meta.verbose_name_plural.lower()}'))
+
+    def backfill(self, queryset, field_name, variants_field):
+        generated = 0
+        pending = deque()
+        for instance in queryset.iterator():
+            file = getattr(instance, field_name)
+            try:
+                with file.open('rb') as opened:
+                    raw = opened.read()
+            except OSError as error:
+                self.stdout.write(self.style.WARNING(
+                    f'Skipping {file.name}: {error}'))
+                continue
+            pending.append(
+                (instance, image_pipeline.submit(process_stored_image, raw)))
+            if len(pending) >= image_pipeline.workers * 2:
+                generated += self.store(*pending.popleft(),
+                                        field_name, variants_field)
+        while pending:
+            generated += self.store(*pending.popleft(),
+                                    field_name, variants_field)
+        return generated
+
+    def store(self, instance, future, field_name, variants_field):
+        try:
+            processed = future.result()
+        except Exception as error:
+            self.stdout.write(self.style.WARNING(
+                f'Skipping {getattr(instance, field_name).name}: {error}'))
+            return 0
+        type(instance).objects.filter(pk=instance.pk).update(**{
+            variants_field: save_variants(getattr(instance, field_name),
+                                          processed)})
+        return 1
@@ -0,0 +1,348 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import requests
+import yaml
+
+
+SCENARIOS = {
+    'browse': (
+        ('get', '/api/recipes/'),
+        ('get', '/api/recipes/{id}/'),
+        ('get', '/api/ingredients/'),
+        ('get', '/api/users/{id}/'),
+    ),
+    'feed': (
+        ('get', '/api/users/me/'),
+        ('get', '/api/recipes/'),
+        ('get', '/api/users/subscriptions/'),
+    ),
+    'toggle': (
+        ('post', '/api/recipes/{id}/favorite/'),
+        ('delete', '/api/recipes/{id}/favorite/'),
+        ('post', '/api/recipes/{id}/shopping_cart/'),
+        ('delete', '/api/recipes/{id}/shopping_cart/'),
+    ),
+    'download': (
+        ('get', '/api/recipes/download_shopping_cart/'),
+    ),
+}
+AUTHENTICATED_SCENARIOS = {'feed', 'toggle', 'download'}
+DEFAULT_MIX = 'browse=50,feed=25,toggle=15,download=10'
+PATH_PARAMETER_RE = re.compile(r'{(\w+)}')
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(round(fraction * len(sorted_values) + 0.5) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise CommandError(f'Unknown scenario "{name}"')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Operation:
+    """An operation of the OpenAPI schema with a query generator."""
+
+    def __init__(self, method, path, spec):
+        self.method = method
+        self.path = path
+        self.name = f'{method.upper()} {path}'
+        self.expected = {int(status) for status in spec.get('responses', {})
+                         if status.isdigit()}
+        self.query = [parameter for parameter in spec.get('parameters', ())
+                      if parameter.get('in') == 'query']
+
+    def build_query(self, samples, rng, authenticated):
+        query = {}
+        for parameter in self.query:
+            name = parameter['name']
+            schema = parameter.get('schema', {})
+            if name in ('is_favorited', 'is_in_shopping_cart'):
+                if authenticated and rng.random() < 0.3:
+                    query[name] = 1
+            elif name == 'page':
+                query[name] = 1
+            elif name in ('limit', 'recipes_limit'):
+                query[name] = rng.choice((6, 6, 12))
+            elif name == 'author' and rng.random() < 0.2:
+                query[name] = rng.choice(samples['users'])
+            elif name == 'name':
+                query[name] = rng.choice(samples['ingredient_prefixes'])
+            elif 'enum' in schema and rng.random() < 0.2:
+                query[name] = rng.choice(schema['enum'])
+        # Only the unfiltered recipe list is known to have further pages.
+        if (self.path == '/api/recipes/' and 'page' in query
+                and query.keys() <= {'page', 'limit'}):
+            query['page'] = rng.randint(
+                1, max(samples['recipe_count'] // query.get('limit', 6), 1))
+        return query
+
+
+class Command(BaseCommand):
+    help = ('Generates a traffic mix from the OpenAPI schema against a '
+            'running server and reports latency percentiles')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--base-url',
+            default='http://localhost:8000',
+        )
+        parser.add_argument(
+            '--schema',
+            default=os.path.join(settings.BASE_DIR, '..', 'docs',
+                                 'openapi-schema.yml'),
+        )
+        parser.add_argument(
+            '--users-file',
+            default=os.path.join(settings.BASE_DIR, '..', 'data',
+                                 'users.json'),
+            help='JSON list of users with email and password to log in as',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=10,
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=30,
+            help='Seconds to generate load for',
+        )
+        parser.add_argument(
+            '--mix',
+            type=parse_mix,
+            default=DEFAULT_MIX,
+            help=f'Scenario weights (default: {DEFAULT_MIX})',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=None,
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=10,
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='Report file (default: loadtest-<timestamp>.json)',
+        )
+
+    def handle(self, *args, **options):
+        self.base_url = options['base_url'].rstrip('/')
+        self.timeout = options['timeout']
+        self.operations = self.load_operations(options['schema'])
+        self.tokens = self.log_in(options['users_file'])
+        self.samples = self.discover()
+
+        mix = dict(options['mix'])
+        if not self.tokens:
+            for name in AUTHENTICATED_SCENARIOS & set(mix):
+                self.stdout.write(self.style.WARNING(
+                    f'No user could log in, skipping "{name}"'))
+                del mix[name]
+        if not mix:
+            raise CommandError('Nothing to run')
+
+        self.results = defaultdict(list)
+        self.lock = threading.Lock()
+        seed = options['seed']
+        deadline = time.monotonic() + options['duration']
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            workers = [
+                executor.submit(self.run_worker, mix, deadline,
+                                random.Random(  # nosec B311
+                                    None if seed is None else seed + worker))
+                for worker in range(options['concurrency'])]
+        for worker in workers:
+            worker.result()
+        elapsed = time.perf_counter() - started
+
+        report = self.build_report(options, mix, elapsed)
+        output = options['output'] or time.strftime(
+            'loadtest-%Y%m%d-%H%M%S.json')
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        self.print_report(report)
+        self.stdout.write(self.style.SUCCESS(f'Report written to {output}'))
+
+    def load_operations(self, schema_path):
+        with open(schema_path, encoding='utf-8') as file:
+            paths = yaml.safe_load(file)['paths']
+        operations = {}
+        for steps in SCENARIOS.values():
+            for method, path in steps:
+                spec = paths.get(path, {}).get(method)
+                if spec is None:
+                    raise CommandError(
+                        f'{method.upper()} {path} is not in the schema')
+                operations[method, path] = Operation(method, path, spec)
+        return operations
+
+    def request(self, session, method, path, **kwargs):
+        return session.request(method, self.base_url + path,
+                               timeout=self.timeout, **kwargs)
+
+    def log_in(self, users_file):
+        try:
+            with open(users_file, encoding='utf-8') as file:
+                users = json.load(file)
+        except FileNotFoundError:
+            return []
+        tokens = []
+        with requests.Session() as session:
+            for user in users:
+                response = self.request(
+                    session, 'post', '/api/auth/token/login/',
+                    json={'email': user['email'],
+                          'password': user['password']})
+                if response.status_code == 200:
+                    tokens.append(response.json()['auth_token'])
+        return tokens
+
+    def discover(self):
+        """Collect ids to fill path and query parameters with."""
+        with requests.Session() as session:
+            page = self.request(session, 'get', '/api/recipes/',
+                                params={'limit': 100}).json()
+            recipes = page['results']
+            ingredients = self.request(session, 'get',
+                                       '/api/ingredients/').json()
+            if not recipes:
+                raise CommandError('The server has no recipes to request')
+            for token in self.tokens:
+                # Downloads answer 404 for an empty shopping cart.
+                self.request(
+                    session, 'post',
+                    f'/api/recipes/{recipes[0]["id"]}/shopping_cart/',
+                    headers={'Authorization': f'Token {token}'})
+        return {
+            'recipes': [recipe['id'] for recipe in recipes],
+            'recipe_count': page['count'],
+            'users': sorted({recipe['author']['id'] for recipe in recipes}),
+            'ingredient_prefixes': sorted({
+                ingredient['name'][:2] for ingredient in ingredients}),
+        }
+
+    def run_worker(self, mix, deadline, rng):
+        names, weights = zip(*mix.items())
+        sessions = {}
+        while time.monotonic() < deadline:
+            scenario = rng.choices(names, weights)[0]
+            token = None
+            if scenario in AUTHENTICATED_SCENARIOS:
+                token = rng.choice(self.tokens)
+            session = sessions.get(token)
+            if session is None:
+                session = sessions[token] = requests.Session()
+                if token:
+                    session.headers['Authorization'] = f'Token {token}'
+            self.run_scenario(scenario, session, rng, token is not None)
+        for session in sessions.values():
+            session.close()
+
+    def run_scenario(self, scenario, session, rng, authenticated):
+        recipe_id = rng.choice(self.samples['recipes'])
+        for method, path in SCENARIOS[scenario]:
+            operation = self.operations[method, path]
+            url = PATH_PARAMETER_RE.sub(
+                lambda match: str(
+                    recipe_id if path.startswith('/api/recipes/')
+                    else rng.choice(self.samples['users'])),
+                path)
+            query = operation.build_query(self.samples, rng, authenticated)
+            started = time.perf_counter()
+            try:
+                response = self.request(session, method, url, params=query)
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            latency = time.perf_counter() - started
+            with self.lock:
+                self.results[operation.name].append(
+                    (latency, status, status in operation.expected
+                     and status < 500))
+
+    def build_report(self, options, mix, elapsed):
+        endpoints = {}
+        total = errors = 0
+        for name, results in sorted(self.results.items()):
+            latencies = sorted(latency * 1000 for latency, _, _ in results)
+            failed = sum(1 for _, _, ok in results if not ok)
+            statuses = defaultdict(int)
+            for _, status, _ in results:
+                statuses[str(status)] += 1
+            endpoints[name] = {
+                'requests': len(results),
+                'errors': failed,
+                'error_rate': failed / len(results),
+                'throughput_rps': len(results) / elapsed,
+                'statuses': dict(statuses),
+                'latency_ms': {
+                    'mean': sum(latencies) / len(latencies),
+                    'p50': percentile(latencies, 0.50),
+                    'p95': percentile(latencies, 0.95),
+                    'p99': percentile(latencies, 0.99),
+                    'max': latencies[-1],
+                },
+            }
+            total += len(results)
+            errors += failed
+        return {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': {
+                'base_url': self.base_url,
+                'concurrency': options['concurrency'],
+                'duration': options['duration'],
+                'mix': mix,
+                'seed': options['seed'],
+                'users': len(self.tokens),
+            },
+            'summary': {
+                'requests': total,
+                'errors': errors,
+                'error_rate': errors / total if total else 0,
+                'elapsed_s': elapsed,
+                'throughput_rps': total / elapsed,
+            },
+            'endpoints': endpoints,
+        }
+
+    def print_report(self, report):
+        self.stdout.write(
+            f'{"endpoint":<45} {"reqs":>6} {"err%":>6} {"rps":>7} '
+            f'{"p50":>7} {"p95":>7} {"p99":>7}')
+        for name, stats in report['endpoints'].items():
+            latency = stats['latency_ms']
+            self.stdout.write(
+                f'{name:<45} {stats["requests"]:>6} '
+                f'{stats["error_rate"] * 100:>6.1f} '
+                f'{stats["throughput_rps"]:>7.1f} {latency["p50"]:>7.1f} '
+                f'{latency["p95"]:>7.1f} {latency["p99"]:>7.1f}')
+        summary = report['summary']
+        self.stdout.write(
+            f'{summary["requests"]} requests in {summary["elapsed_s"]:.1f}s, '
+            f'{summary["throughput_rps"]:.1f} req/s, '
+            f'{summary["error_rate"] * 100:.2f}% errors')
@@ -1,6 +1,91 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+COUNT_CACHE_TIMEOUT = 60
+
+
+def approximate_count(queryset):
+    """Estimate the number of rows without a full COUNT(*) when possible.
+
+    An unfiltered Postgres table is estimated from pg_class.reltuples,
+    anything else is counted exactly once and cached for a short time.
+    """
+    if not isinstance(queryset, QuerySet):
+        # Merged querysets (the feed) are counted exactly.
+        return queryset.count()
+    if connection.vendor == 'postgresql' and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] >= 0:
+            return row[0]
+
+    sql, params = queryset.query.sql_with_params()
+    key = 'count:' + hashlib.sha256(f'{sql}{params}'.encode()).hexdigest()
+    return cache.get_or_set(key, queryset.count, COUNT_CACHE_TIMEOUT)
+
+
+class ApproximateCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return approximate_count(self.object_list)
+
+
+class KeysetPagination(CursorPagination):
+    ordering = '-id'
+    page_size = 6
+    page_size_query_param = 'limit'
+    count_query_param = 'count'
+    count = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.count_query_param) == 'approx':
+            self.count = approximate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = {}
+        if self.count is not None:
+            response['count'] = self.count
+        response.update(next=self.get_next_link(),
+                        previous=self.get_previous_link(),
+                        results=data)
+        return Response(response)
 
 
 class PagePagination(PageNumberPagination):
+    """Page number pagination with an opt-in keyset mode.
+
+    Passing ?cursor= (empty for the first page) switches to cursor
+    pagination over -id, ?count=approx replaces the exact total with an
+    estimate.
+    """
+
     page_size_query_param = 'limit'
     page_size = 6
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param in request.query_params:
+            self.keyset = KeysetPagination()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        if request.query_params.get(self.count_query_param) == 'approx':
+            self.django_paginator_class = ApproximateCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,158 @@
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+import logging
+import random
+import re
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_current_profile = ContextVar('current_profile', default=None)
+
+IN_LIST_RE = re.compile(r'\((?:%s, )+%s\)')
+TOP_QUERIES = 5
+
+
+def fingerprint(sql):
+    """Collapse IN lists so queries differing only in arity match."""
+    return IN_LIST_RE.sub('(...)', sql)
+
+
+class RequestProfile:
+    """Timings and SQL statements recorded for one sampled request."""
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.queries = []
+        self.view_started = None
+        self.active = set()
+
+    def record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - started, sql))
+
+    @property
+    def sql_time(self):
+        return sum(duration for duration, _ in self.queries)
+
+    def slowest_queries(self):
+        return sorted(self.queries, key=lambda query: query[0],
+                      reverse=True)[:TOP_QUERIES]
+
+    def duplicate_queries(self):
+        counts = Counter(fingerprint(sql) for _, sql in self.queries)
+        return [(count, sql) for sql, count in counts.most_common(TOP_QUERIES)
+                if count > 1]
+
+    def server_timing(self, total):
+        metrics = [f'db;dur={self.sql_time * 1000:.1f};'
+                   f'desc="{len(self.queries)} queries"']
+        for name in ('view', 'serializer', 'render'):
+            if name in self.timings:
+                metrics.append(f'{name};dur={self.timings[name] * 1000:.1f}')
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current request profile.
+
+    Only the outermost block of a name is counted, so a serializer nested
+    in another timed serializer is not added to the metric twice.
+    """
+    profile = _current_profile.get()
+    if profile is None or name in profile.active:
+        yield
+        return
+    profile.active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings[name] += time.perf_counter() - started
+        profile.active.discard(name)
+
+
+class PerformanceMiddleware:
+    """Profile a sample of requests and log slow ones.
+
+    Sampled requests (PERFORMANCE['SAMPLE_RATE']) record every SQL
+    statement, view, serializer and render time and get a Server-Timing
+    header. Any request slower than PERFORMANCE['SLOW_REQUEST_MS'] is
+    logged, with its slowest and repeated queries when it was sampled.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.PERFORMANCE['SAMPLE_RATE']
+        self.slow_request = settings.PERFORMANCE['SLOW_REQUEST_MS'] / 1000
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        if random.random() >= self.sample_rate:  # nosec B311
+            response = self.get_response(request)
+            total = time.perf_counter() - started
+            if total > self.slow_request:
+                self.log_slow_request(request, response, total)
+            return response
+
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(profile.record_query))
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        total = time.perf_counter() - started
+        if 'view' not in profile.timings and profile.view_started:
+            profile.timings['view'] = (time.perf_counter()
+                                       - profile.view_started)
+        response['Server-Timing'] = profile.server_timing(total)
+        if total > self.slow_request:
+            self.log_slow_request(request, response, total, profile)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.view_started = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        profile = _current_profile.get()
+        if profile is None or profile.view_started is None:
+            return response
+        view_finished = time.perf_counter()
+        profile.timings['view'] = view_finished - profile.view_started
+
+        def rendered(response):
+            profile.timings['render'] = time.perf_counter() - view_finished
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def log_slow_request(self, request, response, total, profile=None):
+        message = ['Slow request %s %s: %s in %.0f ms']
+        args = [request.method, request.get_full_path(),
+                response.status_code, total * 1000]
+        if profile is not None:
+            message.append('%d queries in %.0f ms')
+            args += [len(profile.queries), profile.sql_time * 1000]
+            for duration, sql in profile.slowest_queries():
+                message.append('  %.1f ms: %s')
+                args += [duration * 1000, sql]
+            for count, sql in profile.duplicate_queries():
+                message.append('  repeated %d times: %s')
+                args += [count, sql]
+        logger.warning('\n'.join(message), *args)
@@ -0,0 +1,81 @@
+"""EXPLAIN the queries of the main endpoints and find sequential scans.
+
+Used by the check_query_plans command on a seeded database and by
+api.tests.QueryPlanTest.
+"""
+import json
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from recipes.models import (Favorite, FeedEntry, Ingredient,
+                            IngredientInRecipe, Recipe, ShoppingCart,
+                            ShoppingListItem, Subscription, User)
+
+
+LARGE_TABLE_MODELS = (User, Recipe, Ingredient, IngredientInRecipe,
+                      Favorite, ShoppingCart, ShoppingListItem, Subscription,
+                      FeedEntry)
+
+
+def endpoints(recipe, author, ingredient):
+    return (
+        ('recipe list', '/api/recipes/'),
+        ('recipe list, cursor', '/api/recipes/?cursor='),
+        ('recipe list by author', f'/api/recipes/?author={author.id}'),
+        ('favorites', '/api/recipes/?is_favorited=1'),
+        ('shopping cart', '/api/recipes/?is_in_shopping_cart=1'),
+        ('feed', '/api/recipes/feed/?cursor='),
+        ('recipe detail', f'/api/recipes/{recipe.id}/'),
+        ('shopping list', '/api/recipes/download_shopping_cart/'),
+        ('user list', '/api/users/'),
+        ('user detail', f'/api/users/{author.id}/'),
+        ('subscriptions', '/api/users/subscriptions/?recipes_limit=3'),
+        ('ingredient detail', f'/api/ingredients/{ingredient.id}/'),
+    )
+
+
+def large_tables(min_rows):
+    return {model._meta.db_table for model in LARGE_TABLE_MODELS
+            if model.objects.count() >= min_rows}
+
+
+def seq_scans(plan):
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', ()):
+        yield from seq_scans(child)
+
+
+def explain(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan
+
+
+def check_endpoint(client, url, tables):
+    """GET url and EXPLAIN its SELECTs.
+
+    Returns the response, the (sql, plan) pairs and the tables among
+    tables that a plan reads with a sequential scan.
+    """
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(url)
+        if response.streaming:
+            b''.join(response.streaming_content)
+    plans = []
+    scanned = set()
+    for query in context.captured_queries:
+        sql = query['sql']
+        if not sql.startswith('SELECT'):
+            continue
+        # A bare COUNT(*) for pagination reads the whole table by
+        # design; ?cursor= avoids it.
+        if sql.startswith('SELECT COUNT(*)') and ' WHERE ' not in sql:
+            continue
+        plan = explain(sql)
+        plans.append((sql, plan))
+        scanned |= set(seq_scans(plan[0]['Plan'])) & tables
+    return response, plans, scanned
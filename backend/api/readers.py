@@ -0,0 +1,91 @@
+"""Read-only responses assembled from .values() rows.
+
+Recipe and user lists spend most of their time instantiating serializer
+fields for every object. The builders below produce the same dicts as
+RecipeSerializer and UserSerializer straight from database rows.
+api.tests.ReadParityTest compares both, check_read_parity does the same
+on a live database.
+"""
+from recipes.models import IngredientInRecipe
+
+from .fields import file_url, image_variants_representation
+from .performance import timed
+from .serializers import (IngredientInRecipeSerializer,
+                          RecipeAuthorSerializer, RecipeSerializer,
+                          UserSerializer)
+
+
+FILE_FIELDS = {'image', 'avatar'}
+VARIANT_FIELDS = {'image_variants', 'avatar_variants'}
+RELATION_FIELDS = {'is_subscribed', 'is_favorited', 'is_in_shopping_cart'}
+USER_COLUMNS = tuple(field for field in UserSerializer.Meta.fields
+                     if field not in RELATION_FIELDS)
+AUTHOR_COLUMNS = tuple(field for field in RecipeAuthorSerializer.Meta.fields
+                       if field not in RELATION_FIELDS)
+RECIPE_COLUMNS = (
+    tuple(field for field in RecipeSerializer.Meta.fields
+          if field not in RELATION_FIELDS | {'author', 'ingredients'})
+    + tuple(f'author__{field}' for field in AUTHOR_COLUMNS)
+)
+
+
+def recipe_values(queryset):
+    """Rows of a RecipeViewSet queryset for build_recipes()."""
+    return queryset.prefetch_related(None).values(*RECIPE_COLUMNS)
+
+
+def user_values(queryset):
+    """Rows of a UserViewSet queryset for build_users()."""
+    return queryset.values(*USER_COLUMNS)
+
+
+def represent(row, request, fields, prefix=''):
+    representation = {}
+    for field in fields:
+        value = row[prefix + field]
+        if field in FILE_FIELDS:
+            value = file_url(value, request)
+        elif field in VARIANT_FIELDS:
+            value = image_variants_representation(value, request)
+        representation[field] = value
+    return representation
+
+
+def build_users(rows, request, relations):
+    """Representation of user rows, relations are api.relation_sets."""
+    with timed('serializer'):
+        return [represent(
+            dict(row, is_subscribed=row['id'] in relations['subscriptions']),
+            request, UserSerializer.Meta.fields) for row in rows]
+
+
+def build_recipes(rows, request, relations):
+    """Representation of recipe rows, ingredients are read in one query.
+
+    Like IngredientInRecipeSerializer, 'id' is the id of the recipe
+    ingredient row.
+    """
+    rows = list(rows)
+    ingredients = {row['id']: [] for row in rows}
+    for recipe_id, *values in IngredientInRecipe.objects.filter(
+            recipe_id__in=ingredients).order_by('id').values_list(
+                'recipe_id', 'id', 'ingredient__name',
+                'ingredient__measurement_unit', 'amount'):
+        ingredients[recipe_id].append(
+            dict(zip(IngredientInRecipeSerializer.Meta.fields, values)))
+
+    with timed('serializer'):
+        recipes = []
+        for row in rows:
+            row = dict(
+                row,
+                author__is_subscribed=(row['author__id']
+                                       in relations['subscriptions']),
+                is_favorited=row['id'] in relations['favorites'],
+                is_in_shopping_cart=row['id'] in relations['carts'],
+                ingredients=ingredients[row['id']])
+            row['author'] = represent(
+                row, request, RecipeAuthorSerializer.Meta.fields, 'author__')
+            recipes.append(
+                represent(row, request, RecipeSerializer.Meta.fields))
+        return recipes
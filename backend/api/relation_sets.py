@@ -0,0 +1,160 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from recipes.models import Favorite, ShoppingCart, Subscription
+
+from .response_cache import bump_version, get_version, local_copy_timeout
+
+
+# Larger id lists are left to the database as subqueries.
+MAX_IDS_IN_QUERY = 10000
+
+RELATIONS = {
+    'favorites': (Favorite, 'recipe_id'),
+    'carts': (ShoppingCart, 'recipe_id'),
+    'subscriptions': (Subscription, 'author_id'),
+}
+RELATION_NAMES = {model: name for name, (model, _) in RELATIONS.items()}
+
+
+def relations_namespace(user_id):
+    return f'relations:{user_id}'
+
+
+class RelationSet:
+    """Sorted array of related ids with O(log n) membership tests."""
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids=()):
+        self.ids = array('q', sorted(ids))
+
+    def __contains__(self, value):
+        index = bisect_left(self.ids, value)
+        return index < len(self.ids) and self.ids[index] == value
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, values):
+        for value in values:
+            index = bisect_left(self.ids, value)
+            if index == len(self.ids) or self.ids[index] != value:
+                self.ids.insert(index, value)
+
+    def discard(self, values):
+        for value in values:
+            index = bisect_left(self.ids, value)
+            if index < len(self.ids) and self.ids[index] == value:
+                del self.ids[index]
+
+
+EMPTY_RELATIONS = {name: RelationSet() for name in RELATIONS}
+
+
+def load_relations(user_id):
+    return {
+        name: RelationSet(model.objects.filter(user_id=user_id).values_list(
+            column, flat=True))
+        for name, (model, column) in RELATIONS.items()
+    }
+
+
+class RelationSetCache:
+    """Favorite, cart and subscription ids of recently active users.
+
+    Sets are loaded with one query per relation and kept in a bounded
+    LRU. The views update them in place once their transaction commits
+    and bump the user's 'relations:<id>' generation in the response
+    cache. When that cache is shared, other processes then reload
+    instead of answering from stale sets; with a per-process cache they
+    only reload after the short LOCAL_TIMEOUT. Writes that bypass the
+    views are picked up after the timeout.
+    """
+
+    def __init__(self, max_users, timeout):
+        self.max_users = max_users
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        if not user.is_authenticated:
+            return EMPTY_RELATIONS
+        version = get_version(relations_namespace(user.pk))
+        with self._lock:
+            entry = self._entries.get(user.pk)
+            if (entry is not None and entry[1] == version
+                    and entry[2] > time.monotonic()):
+                self._entries.move_to_end(user.pk)
+                return entry[0]
+
+        relations = load_relations(user.pk)
+        with self._lock:
+            self._entries[user.pk] = (relations, version,
+                                      time.monotonic() + self.timeout)
+            self._entries.move_to_end(user.pk)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return relations
+
+    def add(self, user_id, name, ids):
+        self._update(user_id, name, ids, RelationSet.add)
+
+    def remove(self, user_id, name, ids):
+        self._update(user_id, name, ids, RelationSet.discard)
+
+    def _update(self, user_id, name, ids, method):
+        ids = list(ids)
+
+        def apply():
+            namespace = relations_namespace(user_id)
+            previous = get_version(namespace)
+            bump_version(namespace)
+            version = get_version(namespace)
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    return
+                if entry[1] != previous:
+                    # Changed elsewhere meanwhile, reload on next use.
+                    del self._entries[user_id]
+                    return
+                method(entry[0][name], ids)
+                self._entries[user_id] = (entry[0], version, entry[2])
+
+        transaction.on_commit(apply)
+
+
+relation_sets = RelationSetCache(
+    max_users=settings.RELATION_SET_CACHE['MAX_USERS'],
+    timeout=local_copy_timeout(settings.RELATION_SET_CACHE))
+
+
+def get_relations(context):
+    """Relation sets of the requesting user, kept in serializer context."""
+    relations = context.get('relations')
+    if relations is None:
+        request = context.get('request')
+        if request is None:
+            return EMPTY_RELATIONS
+        relations = context['relations'] = relation_sets.get(request.user)
+    return relations
+
+
+def filter_by_relation(queryset, user, name):
+    """Limit a queryset to the objects a user has a relation to."""
+    ids = relation_sets.get(user)[name]
+    if len(ids) <= MAX_IDS_IN_QUERY:
+        return queryset.filter(pk__in=list(ids))
+    model, column = RELATIONS[name]
+    return queryset.filter(
+        pk__in=model.objects.filter(user=user).values(column))
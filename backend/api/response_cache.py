@@ -0,0 +1,140 @@
+from functools import wraps
+import time
+from urllib.parse import urlencode
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from recipes.models import Ingredient, IngredientInRecipe, Recipe
+from rest_framework.response import Response
+
+
+User = get_user_model()
+
+RESPONSE_CACHE = 'responses'
+USER_FIELDS_IN_RESPONSES = {'username', 'email', 'first_name',
+                            'last_name', 'avatar'}
+
+
+def get_cache():
+    return caches[RESPONSE_CACHE]
+
+
+def is_shared():
+    """Whether every worker process sees the same response cache."""
+    return not isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def local_copy_timeout(config):
+    """Lifetime of per-process copies invalidated through this cache.
+
+    Version bumps only reach other processes through a shared cache;
+    otherwise the copies are kept for LOCAL_TIMEOUT seconds only.
+    """
+    return config['TIMEOUT'] if is_shared() else config['LOCAL_TIMEOUT']
+
+
+def get_version(namespace):
+    """Return the current generation of a cached namespace.
+
+    A missing counter starts from the current time rather than from 1, so
+    entries written under an evicted counter can never be served again.
+    """
+    cache = get_cache()
+    key = f'version:{namespace}'
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def validator_version(namespace):
+    """Generation of a namespace to derive ETags from.
+
+    Bumps made by other processes only reach a shared cache. With a
+    per-process cache the value also changes every cache timeout, so a
+    stale ETag lives no longer than a stale cached response.
+    """
+    version = get_version(namespace)
+    if is_shared():
+        return version
+    return version, int(time.time() // get_cache().default_timeout)
+
+
+def bump_version(namespace):
+    cache = get_cache()
+    key = f'version:{namespace}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def cache_anonymous_response(namespace):
+    """Cache successful responses of a view action for anonymous users.
+
+    The key includes the namespace generation, so bump_version()
+    invalidates every cached response at once.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            if request.user.is_authenticated:
+                return method(self, request, *args, **kwargs)
+
+            query = urlencode(sorted(
+                (key, value)
+                for key, values in request.query_params.lists()
+                for value in values))
+            key = (f'response:{namespace}:{get_version(namespace)}:'
+                   f'{request.get_host()}{request.path}?{query}')
+            cache = get_cache()
+            data = cache.get(key)
+            if data is not None:
+                return Response(data)
+
+            response = method(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data)
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate_model(model):
+    """Bump the namespaces a save of the model makes stale.
+
+    For saves whose signals fire in another process, such as images
+    stored by the image workers.
+    """
+    if model is User:
+        bump_version('users')
+    if model in (Recipe, Ingredient, User):
+        bump_version('recipes')
+
+
+def bump_recipes_version():
+    transaction.on_commit(lambda: bump_version('recipes'))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_save, sender=IngredientInRecipe)
+@receiver(post_delete, sender=IngredientInRecipe)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_recipes(**kwargs):
+    bump_recipes_version()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_recipes_on_user_change(update_fields=None, **kwargs):
+    if update_fields is None or USER_FIELDS_IN_RESPONSES & update_fields:
+        bump_recipes_version()
+        transaction.on_commit(lambda: bump_version('users'))
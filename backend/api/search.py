@@ -0,0 +1,98 @@
+from bisect import bisect_left
+from collections import defaultdict
+import re
+import threading
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Case, FloatField, When
+from recipes.models import SEARCH_CONFIG, Recipe
+
+from .response_cache import get_version
+
+
+TOKEN_RE = re.compile(r'\w+')
+# Same weights as ts_rank uses by default for A and B labels.
+FIELD_WEIGHTS = (('name', 1.0), ('text', 0.4))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.casefold().replace('ё', 'е'))
+
+
+class RecipeSearchIndex:
+    """Process-local inverted index over recipe names and descriptions.
+
+    Used where PostgreSQL full-text search is not available. Every query
+    term must match the beginning of a word, which roughly stands in for
+    stemming. The index is rebuilt when the 'recipes' cache version
+    changes.
+    """
+
+    def __init__(self):
+        self._entries = ([], {})
+        self._version = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, version):
+        postings = defaultdict(lambda: defaultdict(float))
+        for recipe_id, *values in Recipe.objects.values_list(
+                'id', *(field for field, _ in FIELD_WEIGHTS)):
+            for value, (_, weight) in zip(values, FIELD_WEIGHTS):
+                for token in tokenize(value):
+                    postings[token][recipe_id] += weight
+        self._entries = (sorted(postings), dict(postings))
+        self._version = version
+
+    def search(self, query, limit=None):
+        """Return recipe ids matching every term, best matches first."""
+        version = get_version('recipes')
+        if self._version != version:
+            with self._lock:
+                if self._version != version:
+                    self.rebuild(version)
+
+        tokens, postings = self._entries
+        scores = None
+        for term in set(tokenize(query)):
+            term_scores = defaultdict(float)
+            start = bisect_left(tokens, term)
+            end = bisect_left(tokens, term + '\U0010ffff', lo=start)
+            for token in tokens[start:end]:
+                for recipe_id, score in postings[token].items():
+                    term_scores[recipe_id] += score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {recipe_id: score + term_scores[recipe_id]
+                          for recipe_id, score in scores.items()
+                          if recipe_id in term_scores}
+        if not scores:
+            return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return ranked[:limit]
+
+
+recipe_search_index = RecipeSearchIndex()
+
+
+def search_recipes(queryset, query):
+    """Filter recipes by a full-text query and order them by rank."""
+    if connection.vendor == 'postgresql':
+        search_query = SearchQuery(query, config=SEARCH_CONFIG,
+                                   search_type='websearch')
+        return queryset.filter(search_vector=search_query).annotate(
+            rank=SearchRank('search_vector', search_query)
+        ).order_by('-rank', '-id')
+
+    ranked = recipe_search_index.search(
+        query, limit=settings.RECIPE_SEARCH_LIMIT)
+    if not ranked:
+        return queryset.none()
+    rank = Case(
+        *[When(pk=recipe_id, then=score) for recipe_id, score in ranked],
+        output_field=FloatField())
+    return queryset.filter(
+        pk__in=[recipe_id for recipe_id, _ in ranked]
+    ).annotate(rank=rank).order_by('-rank', '-id')
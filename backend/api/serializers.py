@@ -1,7 +1,15 @@
 from rest_framework import serializers
-from recipes.models import Ingredient, IngredientInRecipe, Recipe, Subscription
+from recipes.models import (Ingredient, IngredientInRecipe, Recipe,
+                            ShoppingListItem)
+from django.db import transaction
+from django.db.models import F
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .fields import Base64ToImageField, Base64RequiredImageField
+from .fields import (Base64ToImageField, Base64RequiredImageField,
+                     ImageVariantsField)
+from .images import PendingImageSerializerMixin
+from .performance import timed
+from .relation_sets import get_relations
 from rest_framework.exceptions import ValidationError
 from djoser.serializers import UserSerializer as DjoserUserSerializer
 
@@ -9,9 +17,35 @@ from djoser.serializers import UserSerializer as DjoserUserSerializer
 User = get_user_model()
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+def get_recipes_limit(request):
+    try:
+        limit = int(request.query_params.get('recipes_limit'))
+    except (ValueError, TypeError):
+        return None
+    return limit if limit > 0 else None
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
+
+
+class TimedSerializerMixin:
+    """Report the time spent building .data to the request profile."""
+
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
+
+
+class IngredientSerializer(TimedSerializerMixin,
+                           serializers.ModelSerializer):
     class Meta:
         model = Ingredient
+        list_serializer_class = TimedListSerializer
         fields = ('id',
                   'name',
                   'measurement_unit')
@@ -35,12 +69,17 @@ class IngredientInRecipeSerializer(serializers.ModelSerializer):
                   'amount')
 
 
-class BaseRecipeSerializer(serializers.ModelSerializer):
+class BaseRecipeSerializer(TimedSerializerMixin,
+                           serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Recipe
+        list_serializer_class = TimedListSerializer
         fields = ('id',
                   'name',
                   'image',
+                  'image_variants',
                   'cooking_time')
         read_only_fields = ('id',)
 
@@ -48,6 +87,7 @@ class BaseRecipeSerializer(serializers.ModelSerializer):
 class RecipeAuthorSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
     avatar = serializers.ImageField(read_only=True)
+    avatar_variants = ImageVariantsField()
 
     class Meta:
         model = User
@@ -57,14 +97,11 @@ class RecipeAuthorSerializer(serializers.ModelSerializer):
                   'first_name',
                   'last_name',
                   'is_subscribed',
-                  'avatar')
+                  'avatar',
+                  'avatar_variants')
 
     def get_is_subscribed(self, author):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return Subscription.objects.filter(user=request.user,
-                                               author=author).exists()
-        return False
+        return author.pk in get_relations(self.context)['subscriptions']
 
 
 class RecipeSerializer(BaseRecipeSerializer):
@@ -83,19 +120,14 @@ class RecipeSerializer(BaseRecipeSerializer):
             'text')
 
     def get_is_favorited(self, recipe):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return recipe.favorites.filter(user=request.user).exists()
-        return False
+        return recipe.pk in get_relations(self.context)['favorites']
 
     def get_is_in_shopping_cart(self, recipe):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return recipe.shopping_carts.filter(user=request.user).exists()
-        return False
+        return recipe.pk in get_relations(self.context)['carts']
 
 
-class RecipeCreateUpdateSerializer(RecipeSerializer):
+class RecipeCreateUpdateSerializer(PendingImageSerializerMixin,
+                                   RecipeSerializer):
     image = Base64RequiredImageField(required=True)
 
     class Meta(RecipeSerializer.Meta):
@@ -115,19 +147,81 @@ class RecipeCreateUpdateSerializer(RecipeSerializer):
             ingredients_ids.add(ingredient_id)
         return ingredients_data
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients_data = validated_data.pop('ingredients_in_recipe')
         recipe = super().create(validated_data)
         self._create_ingredients(recipe, ingredients_data)
+        User.objects.filter(pk=recipe.author_id).update(
+            recipes_count=F('recipes_count') + 1)
+        Ingredient.objects.filter(
+            pk__in=[ingredient_data['id'].id
+                    for ingredient_data in ingredients_data]
+        ).update(recipes_count=F('recipes_count') + 1)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients_data = validated_data.pop('ingredients_in_recipe', None)
         self.validate_ingredients(ingredients_data)
-        IngredientInRecipe.objects.filter(recipe=instance).delete()
-        self._create_ingredients(instance, ingredients_data)
+        deltas = self._update_ingredients(instance, ingredients_data)
+        ShoppingListItem.objects.apply_deltas(
+            instance.shopping_carts.values_list('user_id', flat=True),
+            deltas)
+        for delta in (1, -1):
+            Ingredient.objects.filter(
+                pk__in=[ingredient_id
+                        for ingredient_id, (_, count) in deltas.items()
+                        if count == delta]
+            ).update(recipes_count=F('recipes_count') + delta)
         return super().update(instance, validated_data)
 
+    def _update_ingredients(self, recipe, ingredients_data):
+        """Write only the rows that differ from the submitted ingredients.
+
+        Returns the (amount, recipe_count) deltas per ingredient.
+        """
+        rows = {row.ingredient_id: row for row in IngredientInRecipe.objects
+                .filter(recipe=recipe).only('id', 'ingredient_id', 'amount')}
+        new_amounts = {ingredient_data['id'].id: ingredient_data['amount']
+                       for ingredient_data in ingredients_data}
+        deltas = self._shopping_list_deltas(
+            {ingredient_id: row.amount for ingredient_id, row in rows.items()},
+            new_amounts)
+
+        removed, changed, added = [], [], []
+        for ingredient_id, (_, count) in deltas.items():
+            if count < 0:
+                removed.append(rows[ingredient_id].id)
+            elif count > 0:
+                added.append(IngredientInRecipe(
+                    recipe=recipe,
+                    ingredient_id=ingredient_id,
+                    amount=new_amounts[ingredient_id]))
+            else:
+                rows[ingredient_id].amount = new_amounts[ingredient_id]
+                changed.append(rows[ingredient_id])
+        if removed:
+            IngredientInRecipe.objects.filter(pk__in=removed).delete()
+        if changed:
+            IngredientInRecipe.objects.bulk_update(changed, ['amount'])
+        if added:
+            IngredientInRecipe.objects.bulk_create(added)
+        return deltas
+
+    @staticmethod
+    def _shopping_list_deltas(old_amounts, new_amounts):
+        deltas = {}
+        for ingredient_id in old_amounts.keys() | new_amounts.keys():
+            old_amount = old_amounts.get(ingredient_id)
+            new_amount = new_amounts.get(ingredient_id)
+            if old_amount == new_amount:
+                continue
+            deltas[ingredient_id] = (
+                (new_amount or 0) - (old_amount or 0),
+                (new_amount is not None) - (old_amount is not None))
+        return deltas
+
     def _create_ingredients(self, recipe, ingredients_data):
         IngredientInRecipe.objects.bulk_create(
             IngredientInRecipe(
@@ -138,27 +232,29 @@ class RecipeCreateUpdateSerializer(RecipeSerializer):
         )
 
 
-class UserSerializer(DjoserUserSerializer):
+class UserSerializer(TimedSerializerMixin, DjoserUserSerializer):
     is_subscribed = serializers.SerializerMethodField(read_only=True)
     avatar = serializers.ImageField(read_only=True)
+    avatar_variants = ImageVariantsField()
 
     class Meta(DjoserUserSerializer.Meta):
         model = User
+        list_serializer_class = TimedListSerializer
         fields = DjoserUserSerializer.Meta.fields + (
             'is_subscribed',
-            'avatar')
+            'avatar',
+            'avatar_variants')
 
     def get_is_subscribed(self, user):
-        request_user = self.context['request'].user
-        if request_user.is_anonymous:
-            return False
-        return Subscription.objects.filter(user=request_user, author=user).exists()
+        is_subscribed = getattr(user, 'is_subscribed', None)
+        if is_subscribed is not None:
+            return is_subscribed
+        return user.pk in get_relations(self.context)['subscriptions']
 
 
 class UserWithRecipes(UserSerializer):
     recipes = serializers.SerializerMethodField(read_only=True)
-    recipes_count = serializers.IntegerField(
-        source='recipes.count', read_only=True)
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta(UserSerializer.Meta):
         fields = UserSerializer.Meta.fields + (
@@ -167,24 +263,44 @@ class UserWithRecipes(UserSerializer):
 
     def get_recipes(self, user):
         request = self.context.get('request')
-        limit = request.query_params.get('recipes_limit')
-        try:
-            limit = int(limit)
-        except (ValueError, TypeError):
-            limit = None
-
-        recipes = user.recipes.all()
-        if limit:
-            recipes = recipes[:limit]
+        recipes = getattr(user, 'limited_recipes', None)
+        if recipes is None:
+            recipes = user.recipes.all()
+            limit = get_recipes_limit(request)
+            if limit:
+                recipes = recipes[:limit]
 
         return BaseRecipeSerializer(recipes,
                                     many=True,
                                     context={'request': request}).data
 
 
-class AvatarSerializer(serializers.ModelSerializer):
+class AvatarSerializer(PendingImageSerializerMixin,
+                       serializers.ModelSerializer):
     avatar = Base64ToImageField(required=True)
 
+    # The response of PUT /users/me/avatar/ has the avatar URL.
+    wait_for_images = True
+
     class Meta:
         model = User
         fields = ('avatar',)
+
+    def update(self, instance, validated_data):
+        pending = self._pop_pending_images(validated_data, instance)
+        for field_name, value in validated_data.items():
+            setattr(instance, field_name, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        self._finalize(instance, pending)
+        return instance
+
+
+class IdListSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_MAX_IDS,
+    )
+
+    def validate_ids(self, ids):
+        return list(dict.fromkeys(ids))
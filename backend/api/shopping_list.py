@@ -0,0 +1,141 @@
+import csv
+from functools import lru_cache
+import io
+import os
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+PDF_FONT_NAME = 'ShoppingListFont'
+PDF_FONT_PATHS = (
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+)
+PDF_FALLBACK_FONT = 'Helvetica'
+
+
+def ingredient_line(number, ingredient):
+    return (f'{number}. {ingredient["ingredient__name"].capitalize()} — '
+            f'{ingredient["total_amount"]} '
+            f'{ingredient["ingredient__measurement_unit"]};')
+
+
+def recipe_line(number, recipe):
+    return f'{number}. {recipe.name} — {recipe.author.username};'
+
+
+def render_txt(ingredients, recipes, created_at):
+    yield 'Список покупок\n\n'
+    yield f'Дата составления: {created_at.strftime("%d.%m.%Y %H:%M:%S")}\n\n'
+    yield 'Продукты:'
+    for number, ingredient in enumerate(ingredients, 1):
+        yield '\n' + ingredient_line(number, ingredient)
+    yield '\n\nРецепты:'
+    for number, recipe in enumerate(recipes, 1):
+        yield '\n' + recipe_line(number, recipe)
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def render_csv(ingredients, recipes, created_at):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Продукт', 'Количество', 'Единица измерения'))
+    for ingredient in ingredients:
+        yield writer.writerow((ingredient['ingredient__name'],
+                               ingredient['total_amount'],
+                               ingredient['ingredient__measurement_unit']))
+
+
+@lru_cache(maxsize=None)
+def get_pdf_font():
+    """Register the Cyrillic TTF font once per process.
+
+    Parsing the font file is the most expensive part of rendering a PDF,
+    so it is done on first use and reused by every later request.
+    """
+    font_paths = (getattr(settings, 'SHOPPING_LIST_PDF_FONT', None),
+                  *PDF_FONT_PATHS)
+    for font_path in filter(None, font_paths):
+        if os.path.exists(font_path):
+            pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, font_path))
+            return PDF_FONT_NAME
+    return PDF_FALLBACK_FONT
+
+
+def render_pdf(ingredients, recipes, created_at):
+    font = get_pdf_font()
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    margin, line_height = 20 * mm, 7 * mm
+    y = height - margin
+
+    def write(text, size=12):
+        nonlocal y
+        if y < margin:
+            pdf.showPage()
+            y = height - margin
+        pdf.setFont(font, size)
+        pdf.drawString(margin, y, text)
+        y -= line_height
+
+    write('Список покупок', size=16)
+    write(f'Дата составления: {created_at.strftime("%d.%m.%Y %H:%M:%S")}')
+    write('')
+    write('Продукты:', size=14)
+    for number, ingredient in enumerate(ingredients, 1):
+        write(ingredient_line(number, ingredient))
+    write('')
+    write('Рецепты:', size=14)
+    for number, recipe in enumerate(recipes, 1):
+        write(recipe_line(number, recipe))
+    pdf.save()
+    # reportlab lays the whole document out before writing it, so the PDF
+    # is returned as a file rather than streamed.
+    buffer.seek(0)
+    return buffer
+
+
+FORMATS = {
+    'txt': ('text/plain; charset=utf-8', render_txt),
+    'csv': ('text/csv; charset=utf-8', render_csv),
+    'pdf': ('application/pdf', render_pdf),
+}
+DEFAULT_FORMAT = 'txt'
+
+
+def select_format(request):
+    """Format asked for with ?format= or the Accept header, text otherwise.
+
+    Unknown formats fall back to text rather than 406, as the endpoint
+    has always answered with a text file.
+    """
+    requested = request.query_params.get('format')
+    if requested in FORMATS:
+        return requested
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        media_type = media_range.split(';')[0].strip()
+        for name, (content_type, _) in FORMATS.items():
+            if media_type == content_type.split(';')[0]:
+                return name
+    return DEFAULT_FORMAT
+
+
+class FirstRendererNegotiation(DefaultContentNegotiation):
+    """Render every Response of the view with its first renderer.
+
+    The shopping list picks its file format itself, so ?format= and Accept
+    must neither answer 404/406 nor turn error details into plain text.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
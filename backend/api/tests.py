@@ -1,3 +1,513 @@
-from django.test import TestCase
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import parse_qsl, urlsplit
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from recipes.models import (FeedEntry, Favorite, Ingredient, Recipe,
+                            ShoppingCart, Subscription, User)
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APITestCase
+
+from .images import ImagePipeline, PendingImage
+from .ingredient_recipes import IngredientRecipeIndex
+from .performance import RequestProfile, _current_profile, timed
+from .query_plans import check_endpoint, endpoints, large_tables
+from .readers import build_recipes, build_users, recipe_values, user_values
+from .relation_sets import relation_sets
+from .renderers import ORJSONRenderer
+from .response_cache import get_version, local_copy_timeout
+from .serializers import RecipeSerializer, UserSerializer
+
+PNG = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJ'
+       'AAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg==')
+
+
+class TimedTest(SimpleTestCase):
+    def test_nested_blocks_are_counted_once(self):
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        try:
+            with mock.patch('api.performance.time.perf_counter',
+                            side_effect=[0.0, 1.0, 3.0, 5.0]):
+                with timed('serializer'):
+                    with timed('serializer'):
+                        pass
+                    with timed('render'):
+                        pass
+        finally:
+            _current_profile.reset(token)
+        self.assertEqual(profile.timings['serializer'], 5.0)
+        self.assertEqual(profile.timings['render'], 2.0)
+        self.assertEqual(profile.active, set())
+
+
+class LocalCopyTimeoutTest(SimpleTestCase):
+    config = {'TIMEOUT': 300, 'LOCAL_TIMEOUT': 5}
+
+    def test_per_process_cache_keeps_copies_briefly(self):
+        self.assertEqual(local_copy_timeout(self.config), 5)
+
+    @override_settings(CACHES={'responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/tmp/responses'}})
+    def test_shared_cache_keeps_copies_for_the_timeout(self):
+        self.assertEqual(local_copy_timeout(self.config), 300)
+
+
+class RelationFlagsTest(APITestCase):
+    """The relation flags and filters agree with the database."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password')
+        cls.viewer = User.objects.create_user(
+            username='viewer', email='viewer@example.com',
+            first_name='Анна', last_name='Иванова', password='password')
+        cls.recipes = [
+            Recipe.objects.create(
+                author=cls.author, name=f'Рецепт {number}',
+                image='recipes/images/recipe.png', text='Описание',
+                cooking_time=10)
+            for number in range(3)
+        ]
+
+    def setUp(self):
+        # Both caches outlive the rolled back test transactions.
+        relation_sets._entries.clear()
+        caches['responses'].clear()
+        self.client.force_authenticate(self.viewer)
+
+    def toggle(self, method, url):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(url)
+        self.assertLess(response.status_code, 300, response.content)
+
+    def list_ids(self, **params):
+        response = self.client.get('/api/recipes/', params)
+        self.assertEqual(response.status_code, 200)
+        return {recipe['id'] for recipe in response.json()['results']}
+
+    def assert_flags_match_database(self):
+        favorites = set(Favorite.objects.filter(
+            user=self.viewer).values_list('recipe_id', flat=True))
+        carts = set(ShoppingCart.objects.filter(
+            user=self.viewer).values_list('recipe_id', flat=True))
+        subscribed = Subscription.objects.filter(
+            user=self.viewer, author=self.author).exists()
+
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        for recipe in response.json()['results']:
+            self.assertEqual(recipe['is_favorited'],
+                             recipe['id'] in favorites)
+            self.assertEqual(recipe['is_in_shopping_cart'],
+                             recipe['id'] in carts)
+            self.assertEqual(recipe['author']['is_subscribed'], subscribed)
+        self.assertEqual(self.list_ids(is_favorited=1), favorites)
+        self.assertEqual(self.list_ids(is_in_shopping_cart=1), carts)
+
+        response = self.client.get(f'/api/users/{self.author.pk}/')
+        self.assertEqual(response.json()['is_subscribed'], subscribed)
+        for recipe in self.recipes:
+            response = self.client.get(f'/api/recipes/{recipe.pk}/')
+            self.assertEqual(response.json()['is_favorited'],
+                             recipe.pk in favorites)
+            self.assertEqual(response.json()['is_in_shopping_cart'],
+                             recipe.pk in carts)
+
+    def test_flags_follow_added_relations(self):
+        self.assert_flags_match_database()
+        first, second, _ = self.recipes
+        self.toggle('post', f'/api/recipes/{first.pk}/favorite/')
+        self.toggle('post', f'/api/recipes/{second.pk}/shopping_cart/')
+        self.toggle('post', f'/api/users/{self.author.pk}/subscribe/')
+        self.assert_flags_match_database()
+
+    def test_flags_follow_removed_relations(self):
+        first, second, _ = self.recipes
+        self.toggle('post', f'/api/recipes/{first.pk}/favorite/')
+        self.toggle('post', f'/api/recipes/{second.pk}/shopping_cart/')
+        self.toggle('post', f'/api/users/{self.author.pk}/subscribe/')
+        self.assert_flags_match_database()
+        self.toggle('delete', f'/api/recipes/{first.pk}/favorite/')
+        self.toggle('delete', f'/api/recipes/{second.pk}/shopping_cart/')
+        self.toggle('delete', f'/api/users/{self.author.pk}/subscribe/')
+        self.assert_flags_match_database()
+
+    def test_bulk_changes_update_flags(self):
+        ids = [recipe.pk for recipe in self.recipes[:2]]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/recipes/favorite/', {'ids': ids},
+                             format='json')
+        self.assert_flags_match_database()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/api/recipes/favorite/', {'ids': ids[:1]},
+                               format='json')
+        self.assert_flags_match_database()
+
+
+class ConditionalGetTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='Рецепт',
+            image='recipes/images/recipe.png', text='Описание',
+            cooking_time=10)
+
+    def setUp(self):
+        caches['responses'].clear()
+
+    def test_cached_anonymous_list_runs_no_queries(self):
+        etag = self.client.get('/api/recipes/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/recipes/',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_edit_changes_the_etag(self):
+        etag = self.client.get(f'/api/recipes/{self.recipe.pk}/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Recipe.objects.get(pk=self.recipe.pk).save()
+        response = self.client.get(f'/api/recipes/{self.recipe.pk}/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class AvatarTest(APITestCase):
+    def test_deleting_the_avatar_keeps_counters(self):
+        user = User.objects.create_user(
+            username='reader', email='reader@example.com',
+            first_name='Анна', last_name='Иванова', password='password')
+        author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        # Caches the user for the token.
+        self.client.get('/api/users/me/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/users/{author.pk}/subscribe/')
+        response = self.client.delete('/api/users/me/avatar/')
+        self.assertEqual(response.status_code, 204)
+        user.refresh_from_db()
+        self.assertEqual(user.subscription_count, 1)
+
+
+class ImagePipelineTest(APITestCase):
+    def test_broken_pool_is_replaced_and_the_image_processed_inline(self):
+        pipeline = ImagePipeline(workers=1, queue_size=1)
+        broken = mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool
+        pipeline._executor = broken
+
+        self.assertEqual(pipeline.submit(pow, 2, 3).result(), 8)
+        self.assertIsNone(pipeline._executor)
+        broken.shutdown.assert_called_once_with(wait=False)
+        # The queue slot was given back.
+        self.assertTrue(pipeline._slots.acquire(blocking=False))
+
+    def test_failed_submit_does_not_raise_after_commit(self):
+        user = User.objects.create_user(
+            username='reader', email='reader@example.com',
+            first_name='Анна', last_name='Иванова', password='password')
+        image = PendingImage('aGVsbG8=')
+        with mock.patch('api.images.image_pipeline.submit',
+                        side_effect=RuntimeError):
+            with self.captureOnCommitCallbacks(execute=True):
+                image.finalize(user, 'avatar')
+        self.assertFalse(image.wait())
+
+    def test_stored_image_bumps_the_parent_cache(self):
+        user = User.objects.create_user(
+            username='reader', email='reader@example.com',
+            first_name='Анна', last_name='Иванова', password='password')
+        versions = get_version('recipes'), get_version('users')
+        image = PendingImage('aGVsbG8=')
+        with mock.patch('api.images.ingest_image', return_value=True), \
+                mock.patch('api.images.image_pipeline.workers', 0):
+            with self.captureOnCommitCallbacks(execute=True):
+                image.finalize(user, 'avatar')
+        self.assertTrue(image.wait())
+        self.assertNotEqual((get_version('recipes'), get_version('users')),
+                            versions)
+
+
+@override_settings(FEED={'FANOUT_MAX_FOLLOWERS': 2, 'BATCH_SIZE': 1,
+                         'BACKFILL_LIMIT': 10, 'FANOUT_WORKERS': 0})
+class FeedTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer, cls.other, cls.author, cls.popular = [
+            User.objects.create_user(
+                username=name, email=f'{name}@example.com',
+                first_name='Анна', last_name='Иванова', password='password')
+            for name in ('viewer', 'other', 'author', 'popular')]
+
+    def setUp(self):
+        caches['responses'].clear()
+
+    def subscribe(self, user, author):
+        self.client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/users/{author.pk}/subscribe/')
+        self.assertEqual(response.status_code, 201)
+
+    def create_recipes(self, author, count):
+        self.client.force_authenticate(author)
+        ingredient = Ingredient.objects.get_or_create(
+            name='мука', measurement_unit='г')[0]
+        for number in range(count):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post('/api/recipes/', {
+                    'name': f'Рецепт {number}', 'text': 'Описание',
+                    'cooking_time': 10 + number, 'image': PNG,
+                    'ingredients': [{'id': ingredient.pk, 'amount': 1}],
+                }, format='json')
+            self.assertEqual(response.status_code, 201, response.content)
+
+    def feed_ids(self, **params):
+        self.client.force_authenticate(self.viewer)
+        response = self.client.get('/api/recipes/feed/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_feed_merges_fanned_out_and_pulled_recipes(self):
+        self.subscribe(self.viewer, self.author)
+        self.subscribe(self.viewer, self.popular)
+        # One recipe fanned out while the author had a single follower.
+        self.create_recipes(self.popular, 1)
+        self.subscribe(self.other, self.popular)
+        self.create_recipes(self.author, 2)
+        self.create_recipes(self.popular, 2)
+        self.create_recipes(self.other, 1)
+        self.assertEqual(FeedEntry.objects.filter(
+            user=self.viewer).count(), 3)
+
+        expected = list(Recipe.objects.filter(
+            author__in=[self.author, self.popular]).order_by(
+                '-id').values_list('id', flat=True))
+        page = self.feed_ids(limit=10)
+        self.assertEqual(page['count'], 5)
+        self.assertEqual([recipe['id'] for recipe in page['results']],
+                         expected)
+
+        ids, params = [], {'cursor': '', 'limit': 2}
+        while True:
+            page = self.feed_ids(**params)
+            ids += [recipe['id'] for recipe in page['results']]
+            if not page['next']:
+                break
+            params = dict(parse_qsl(urlsplit(page['next']).query))
+        self.assertEqual(ids, expected)
+
+        page = self.feed_ids(author=self.popular.pk, cooking_time_min=11)
+        self.assertEqual([recipe['id'] for recipe in page['results']],
+                         expected[:1])
+
+    def test_fan_out_counts_inserted_rows(self):
+        self.subscribe(self.viewer, self.author)
+        self.create_recipes(self.author, 1)
+        recipe = Recipe.objects.get(author=self.author)
+        self.assertEqual(FeedEntry.objects.fan_out(
+            recipe.pk, self.author.pk, batch_size=10), 0)
+
+
+class ReadParityTest(APITestCase):
+    """The .values() read path renders like the serializers."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password',
+            avatar='users/images/avatar.png',
+            avatar_variants={'thumb': {'width': 160, 'height': 160,
+                                       'webp': 'users/images/a_thumb.webp',
+                                       'jpeg': 'users/images/a_thumb.jpg'},
+                             'placeholder': 'data:image/jpeg;base64,AA=='})
+        cls.viewer = User.objects.create_user(
+            username='viewer', email='viewer@example.com',
+            first_name='Анна', last_name='Иванова', password='password')
+        flour = Ingredient.objects.create(name='мука', measurement_unit='г')
+        milk = Ingredient.objects.create(name='молоко',
+                                         measurement_unit='мл')
+        cls.recipes = []
+        for number in range(3):
+            recipe = Recipe.objects.create(
+                author=cls.author, name=f'Рецепт «{number}» ',
+                image='recipes/images/recipe.png', text='Описание\n',
+                cooking_time=10 + number)
+            recipe.ingredients_in_recipe.create(ingredient=flour,
+                                                amount=100 + number)
+            if number:
+                recipe.ingredients_in_recipe.create(ingredient=milk,
+                                                    amount=50)
+            cls.recipes.append(recipe)
+        Favorite.objects.create(user=cls.viewer, recipe=cls.recipes[0])
+        ShoppingCart.objects.create(user=cls.viewer, recipe=cls.recipes[1])
+        Subscription.objects.create(user=cls.viewer, author=cls.author)
+
+    def setUp(self):
+        relation_sets._entries.clear()
+
+    def assert_same_rendering(self, serialized, built):
+        self.assertEqual(len(serialized), len(built))
+        for renderer in (JSONRenderer(), ORJSONRenderer()):
+            for expected, actual in zip(serialized, built):
+                self.assertEqual(renderer.render(actual),
+                                 JSONRenderer().render(expected))
+
+    def compare_as(self, viewer):
+        request = Request(RequestFactory().get('/api/recipes/'))
+        request.user = viewer
+        relations = relation_sets.get(viewer)
+        context = {'request': request}
+
+        recipes = Recipe.objects.order_by('-id')
+        self.assert_same_rendering(
+            RecipeSerializer(recipes, many=True, context=context).data,
+            build_recipes(recipe_values(recipes), request, relations))
+        users = User.objects.order_by('id')
+        self.assert_same_rendering(
+            UserSerializer(users, many=True, context=context).data,
+            build_users(user_values(users), request, relations))
+
+    def test_anonymous(self):
+        self.compare_as(AnonymousUser())
+
+    def test_viewer_with_relations(self):
+        relations = relation_sets.get(self.viewer)
+        self.assertTrue(all(map(len, relations.values())))
+        self.compare_as(self.viewer)
+
+
+class IngredientRecipeIndexTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password')
+        cls.flour = Ingredient.objects.create(name='мука',
+                                              measurement_unit='г')
+        cls.milk = Ingredient.objects.create(name='молоко',
+                                             measurement_unit='мл')
+        cls.recipes = [cls.create_recipe(ingredients)
+                       for ingredients in ([cls.flour],
+                                           [cls.flour, cls.milk],
+                                           [cls.milk])]
+
+    @classmethod
+    def create_recipe(cls, ingredients):
+        recipe = Recipe.objects.create(
+            author=cls.author, name='Рецепт', image='recipes/images/r.png',
+            text='Описание', cooking_time=10)
+        for ingredient in ingredients:
+            recipe.ingredients_in_recipe.create(ingredient=ingredient,
+                                                amount=1)
+        return recipe
+
+    def setUp(self):
+        self.index = IngredientRecipeIndex(ttl=600)
+        patcher = mock.patch.object(self.index, 'build_in_background')
+        self.build_in_background = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ids(self, *recipes):
+        return {recipe.pk for recipe in recipes}
+
+    def test_answers_from_the_database_until_built(self):
+        self.assertIsNone(self.index.all_of([self.flour.pk]))
+        self.build_in_background.assert_called_once_with()
+        with mock.patch('api.ingredient_recipes.ingredient_recipe_index',
+                        self.index):
+            response = self.client.get(
+                '/api/recipes/',
+                {'ingredients': f'{self.flour.pk},{self.milk.pk}'})
+        self.assertEqual([recipe['id'] for recipe in
+                          response.json()['results']], [self.recipes[1].pk])
+
+    def test_set_operations(self):
+        self.index.build()
+        first, both, second = self.recipes
+        self.assertEqual(self.index.all_of([self.flour.pk, self.milk.pk]),
+                         self.ids(both))
+        self.assertEqual(self.index.any_of([self.flour.pk, self.milk.pk]),
+                         self.ids(first, both, second))
+        self.assertEqual(self.index.all_of([self.flour.pk, 0]), set())
+        self.assertIsNone(self.index.any_of([self.flour.pk], limit=1))
+
+    def test_catches_up_with_changed_recipes_only(self):
+        self.index.build()
+        first, both, second = self.recipes
+        both.ingredients_in_recipe.filter(ingredient=self.flour).delete()
+        both.save()
+        added = self.create_recipe([self.flour])
+        with self.assertNumQueries(2):
+            self.assertEqual(self.index.any_of([self.flour.pk]),
+                             self.ids(first, added))
+        self.assertEqual(self.index.any_of([self.milk.pk]),
+                         self.ids(both, second))
+        self.assertEqual(self.index._stamp,
+                         (added.updated_at, added.pk))
+        with self.assertNumQueries(1):
+            self.index.all_of([self.flour.pk])
+
+    def test_rebuilds_after_many_changes(self):
+        self.index.build()
+        with mock.patch('api.ingredient_recipes.MAX_CATCH_UP_RECIPES', 1):
+            self.create_recipe([self.flour])
+            self.create_recipe([self.flour])
+            self.assertIsNone(self.index.all_of([self.flour.pk]))
+        self.build_in_background.assert_called_once_with()
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'Query plans are only checked on PostgreSQL')
+class QueryPlanTest(APITestCase):
+    MIN_ROWS = 10000
+
+    @classmethod
+    def setUpTestData(cls):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'продукт {number}', measurement_unit='г')
+            for number in range(500))
+        call_command('generate_data', users=2000, recipes=20000, workers=1,
+                     stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        relation_sets._entries.clear()
+        caches['responses'].clear()
+
+    def test_hot_queries_do_not_scan_large_tables(self):
+        tables = large_tables(self.MIN_ROWS)
+        self.assertIn(Recipe._meta.db_table, tables)
+        user = User.objects.filter(shopping_carts__isnull=False).first()
+        recipe = Recipe.objects.select_related('author').first()
+        self.client.force_authenticate(user)
+        for name, url in endpoints(recipe, recipe.author,
+                                   Ingredient.objects.first()):
+            with self.subTest(name):
+                response, plans, scanned = check_endpoint(
+                    self.client, url, tables)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(plans)
+                self.assertFalse(scanned)
@@ -1,9 +1,14 @@
 from rest_framework import viewsets, permissions, status
-from recipes.models import Ingredient, IngredientInRecipe, Recipe, ShoppingCart, Favorite, Subscription
+from recipes.bulk import delete_returning, insert_returning
+from recipes.models import (Ingredient, IngredientInRecipe, Recipe,
+                            ShoppingCart, ShoppingListItem, Favorite,
+                            Subscription)
 from rest_framework.decorators import action
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
 from django.http import FileResponse
+from django.utils.http import content_disposition_header
 from .serializers import (
     IngredientSerializer,
     BaseRecipeSerializer,
@@ -12,16 +17,30 @@ from .serializers import (
     UserSerializer,
     UserWithRecipes,
     AvatarSerializer,
+    IdListSerializer,
+    get_recipes_limit,
 )
+from . import feed, shopping_list
+from .conditional import (conditional_get, ingredient_catalogue_version,
+                          relation_version)
+from .filters import RecipeFilter
+from .images import is_placeholder
+from .ingredient_index import ingredient_index
 from .pagination import PagePagination
 from django_filters.rest_framework import DjangoFilterBackend
 from .permissions import IsAuthorOrReadOnly
-from django.db.models import Exists, OuterRef, Count
+from .readers import build_recipes, build_users, recipe_values, user_values
+from .relation_sets import RELATION_NAMES, filter_by_relation, relation_sets
+from .response_cache import cache_anonymous_response, validator_version
+from .search import search_recipes
+from django.db.models import Exists, F, OuterRef, Prefetch, Value, Window
+from django.db.models.functions import RowNumber
 from django.urls import reverse
 from datetime import datetime
 from djoser.views import UserViewSet as DjoserUserViewSet
-from django.db.models import Sum
 from django.http import Http404
+from django.conf import settings
+from django.db import transaction
 
 
 User = get_user_model()
@@ -35,16 +54,35 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         name = self.request.GET.get('name')
         if name:
-            return self.queryset.filter(name__startswith=name)
+            return self.queryset.filter(name__startswith=name.lower())
         return self.queryset
 
+    def get_validators(self):
+        self.catalogue_version = ingredient_catalogue_version()
+        return self.catalogue_version, self.catalogue_version[2]
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        name = request.GET.get('name')
+        limit = settings.INGREDIENT_SEARCH_LIMIT if name else None
+        ingredients = ingredient_index.search(
+            name, limit=limit,
+            version=getattr(self, 'catalogue_version', None))
+        if ingredients is None:
+            ingredients = self.get_queryset()[:limit]
+        return Response(self.get_serializer(ingredients, many=True).data)
+
 
 class RecipeViewSet(viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     pagination_class = PagePagination
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ['author']
+    filterset_class = RecipeFilter
     ordering_fields = ['id', 'name', 'cooking_time']
     permission_classes_by_action = {
         'update': [IsAuthorOrReadOnly],
@@ -52,6 +90,8 @@ class RecipeViewSet(viewsets.ModelViewSet):
         'destroy': [IsAuthorOrReadOnly],
         'list': [permissions.AllowAny],
         'retrieve': [permissions.AllowAny],
+        'download_shopping_cart': [permissions.IsAuthenticated],
+        'feed': [permissions.IsAuthenticated],
         'default': [permissions.IsAuthenticatedOrReadOnly]
     }
 
@@ -71,34 +111,77 @@ class RecipeViewSet(viewsets.ModelViewSet):
                     self.permission_classes_by_action['default']]
 
     def get_queryset(self):
-        queryset = Recipe.objects.all().order_by('-id')
         user = self.request.user
+        queryset = Recipe.objects.select_related('author').prefetch_related(
+            Prefetch('ingredients_in_recipe',
+                     queryset=IngredientInRecipe.objects.select_related(
+                         'ingredient').order_by('id'))
+        ).order_by('-id')
+
+        if (self.request.query_params.get('is_in_shopping_cart') == '1'
+                and user.is_authenticated):
+            queryset = filter_by_relation(queryset, user, 'carts')
+
+        if (self.request.query_params.get('is_favorited') == '1'
+                and user.is_authenticated):
+            queryset = filter_by_relation(queryset, user, 'favorites')
 
-        is_in_shopping_cart = self.request.query_params.get(
-            'is_in_shopping_cart')
-        if is_in_shopping_cart == '1' and user.is_authenticated:
-            queryset = queryset.annotate(
-                is_in_shopping_cart=Exists(
-                    ShoppingCart.objects.filter(
-                        user=user, recipe=OuterRef('pk')
-                    )
-                )
-            ).filter(is_in_shopping_cart=True)
-
-        is_favorited = self.request.query_params.get('is_favorited')
-        if is_favorited == '1' and user.is_authenticated:
-            queryset = queryset.annotate(
-                is_favorited=Exists(
-                    Favorite.objects.filter(
-                        user=user, recipe=OuterRef('pk')
-                    )
-                )
-            ).filter(is_favorited=True)
+        search = self.request.query_params.get('search', '').strip()
+        if search and self.action == 'list':
+            queryset = search_recipes(queryset, search)
 
         return queryset
 
+    def get_validators(self):
+        # Counters only: aggregating the filtered recipes here would run
+        # before the anonymous response cache on every request.
+        return ((validator_version('recipes'),
+                 relation_version(self.request.user)), None)
+
+    @conditional_get
+    @cache_anonymous_response('recipes')
+    def list(self, request, *args, **kwargs):
+        return self._list_recipes(
+            request, self.filter_queryset(self.get_queryset()))
+
+    @action(detail=False,
+            methods=['get'],
+            permission_classes=[permissions.IsAuthenticated])
+    @conditional_get
+    def feed(self, request):
+        """Recipes of the followed authors, newest first."""
+        return self._list_recipes(request, feed.feed_queryset(
+            self.filter_queryset(self.get_queryset()), request.user))
+
+    def _list_recipes(self, request, queryset):
+        rows = recipe_values(queryset)
+        relations = relation_sets.get(request.user)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(
+                build_recipes(page, request, relations))
+        return Response(build_recipes(rows, request, relations))
+
+    @conditional_get
+    @cache_anonymous_response('recipes')
+    def retrieve(self, request, *args, **kwargs):
+        row = get_object_or_404(
+            recipe_values(self.filter_queryset(self.get_queryset())),
+            pk=self.kwargs['pk'])
+        return Response(build_recipes(
+            [row], request, relation_sets.get(request.user))[0])
+
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        feed.recipe_created(serializer.save(author=self.request.user))
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        ShoppingListItem.objects.remove_recipes(
+            instance.shopping_carts.values_list('user_id', flat=True),
+            [instance.id])
+        # The author and ingredient counters are recounted on delete,
+        # see recipes.counters.
+        instance.delete()
 
     @action(detail=True,
             methods=['get'],
@@ -128,6 +211,72 @@ class RecipeViewSet(viewsets.ModelViewSet):
                                              pk,
                                              Favorite)
 
+    @action(detail=False,
+            methods=['post', 'delete'],
+            url_path='shopping_cart',
+            serializer_class=IdListSerializer,
+            permission_classes=[permissions.IsAuthenticated])
+    def shopping_cart_bulk(self, request):
+        return self._bulk_cart_or_favorite(request, ShoppingCart)
+
+    @action(detail=False,
+            methods=['post', 'delete'],
+            url_path='favorite',
+            serializer_class=IdListSerializer,
+            permission_classes=[permissions.IsAuthenticated])
+    def favorite_bulk(self, request):
+        return self._bulk_cart_or_favorite(request, Favorite)
+
+    @transaction.atomic
+    def _bulk_cart_or_favorite(self, request, model):
+        """Add or remove several recipes at once, reporting per-id status."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        user = request.user
+        linked = dict(Recipe.objects.filter(pk__in=ids).annotate(
+            linked=Exists(model.objects.filter(user=user,
+                                               recipe=OuterRef('pk')))
+        ).values_list('id', 'linked'))
+
+        # Counters follow the rows actually written, concurrent requests
+        # may have added or removed some of them since they were read.
+        if request.method == 'POST':
+            changed = insert_returning(
+                model, ('user', 'recipe'),
+                [(user.pk, pk) for pk in ids
+                 if pk in linked and not linked[pk]],
+                returning='recipe')
+            delta, statuses = 1, ('added', 'already_added')
+        else:
+            changed = delete_returning(
+                model.objects.filter(
+                    user=user,
+                    recipe_id__in=[pk for pk in ids if linked.get(pk)]),
+                'recipe_id')
+            delta, statuses = -1, ('removed', 'not_added')
+
+        if changed:
+            Recipe.objects.filter(pk__in=changed).update(
+                **{model.counter_field: F(model.counter_field) + delta})
+            update_relations = (relation_sets.add if delta > 0
+                                else relation_sets.remove)
+            update_relations(user.id, RELATION_NAMES[model], changed)
+            if model is ShoppingCart:
+                ShoppingListItem.objects.apply_deltas(
+                    [user.id],
+                    ShoppingListItem.objects.recipe_deltas(changed, delta))
+        changed = set(changed)
+
+        def get_status(pk):
+            if pk not in linked:
+                return 'not_found'
+            return statuses[0] if pk in changed else statuses[1]
+
+        return Response({'results': [
+            {'id': pk, 'status': get_status(pk)} for pk in ids]})
+
+    @transaction.atomic
     def _handle_cart_or_favorite(self, request, pk, model):
         recipe = self.get_object()
         user = request.user
@@ -140,66 +289,90 @@ class RecipeViewSet(viewsets.ModelViewSet):
                     {'detail': f'Рецепт «{recipe.name}» уже добавлен \
                      в {model._meta.verbose_name.lower()}'},
                     status=status.HTTP_400_BAD_REQUEST)
+            Recipe.objects.filter(pk=recipe.pk).update(
+                **{model.counter_field: F(model.counter_field) + 1})
+            relation_sets.add(user.id, RELATION_NAMES[model], [recipe.id])
+            if model is ShoppingCart:
+                ShoppingListItem.objects.add_recipes([user.id], [recipe.id])
             return Response(self.get_serializer(
                 recipe, context={'request': request}).data,
                 status=status.HTTP_201_CREATED)
-        try:
-            model.objects.get(user=user, recipe=recipe).delete()
+        if delete_returning(model.objects.filter(user=user, recipe=recipe),
+                            'recipe_id'):
+            Recipe.objects.filter(pk=recipe.pk).update(
+                **{model.counter_field: F(model.counter_field) - 1})
+            relation_sets.remove(user.id, RELATION_NAMES[model], [recipe.id])
+            if model is ShoppingCart:
+                ShoppingListItem.objects.remove_recipes([user.id],
+                                                        [recipe.id])
             return Response(status=status.HTTP_204_NO_CONTENT)
-        except model.DoesNotExist:
-            return Response(
-                {'detail': f'Рецепт «{recipe.name}» не был добавлен \
-                 в {model._meta.verbose_name.lower()}'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        return Response(
+            {'detail': f'Рецепт «{recipe.name}» не был добавлен \
+             в {model._meta.verbose_name.lower()}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
 
     @action(detail=False,
             methods=['get'],
-            permission_classes=[permissions.IsAuthenticated])
+            permission_classes=[permissions.IsAuthenticated],
+            content_negotiation_class=shopping_list.FirstRendererNegotiation)
     def download_shopping_cart(self, request):
         user = request.user
-        shopping_cart = ShoppingCart.objects.filter(user=user)
-        if not shopping_cart.exists():
+        recipes = list(Recipe.objects.filter(
+            shopping_carts__user=user
+        ).select_related('author').order_by('shopping_carts__id'))
+        if not recipes:
             return Response({'detail': 'Список покупок пуст'},
                             status=status.HTTP_404_NOT_FOUND)
 
-        recipes = [item.recipe for item in shopping_cart]
-
-        ingredients = IngredientInRecipe.objects.filter(
-            recipe__in=recipes
-        ).values('ingredient__name', 'ingredient__measurement_unit').annotate(
-            total_amount=Sum('amount')
-        ).order_by('ingredient__name')
-
-        content = '\n'.join([
-            'Список покупок\n',
-            f'Дата составления: {datetime.now().strftime("%d.%m.%Y %H:%M:%S")}\n',
-            'Продукты:',
-            *[f'{i}. {ingredient["ingredient__name"].capitalize()} — '
-              f'{ingredient["total_amount"]} {ingredient["ingredient__measurement_unit"]};'
-              for i, ingredient in enumerate(ingredients, 1)],
-            '\nРецепты:',
-            *[f'{i}. {recipe.name} — {recipe.author.username};'
-              for i, recipe in enumerate(recipes, 1)],
-        ])
-
-        return FileResponse(content,
-                            content_type='text/plain; charset=utf-8',
-                            filename='shopping-list.txt')
+        ingredients = ShoppingListItem.objects.filter(
+            user=user
+        ).values('ingredient__name',
+                 'ingredient__measurement_unit',
+                 'total_amount').order_by('ingredient__name')
+
+        file_format = shopping_list.select_format(request)
+        content_type, render = shopping_list.FORMATS[file_format]
+        filename = f'shopping-list.{file_format}'
+        response = FileResponse(
+            render(ingredients.iterator(), recipes, datetime.now()),
+            as_attachment=True,
+            filename=filename,
+            content_type=content_type)
+        # FileResponse only sets it for file objects, not for generators.
+        response['Content-Disposition'] = content_disposition_header(
+            True, filename)
+        return response
 
 
 class UserViewSet(DjoserUserViewSet):
     queryset = User.objects.all().order_by('id')
-    queryset = queryset.annotate(
-        recipes_count=Count('recipes')
-    )
     serializer_class = UserSerializer
     pagination_class = PagePagination
     permission_classes = [permissions.AllowAny]
 
+    def get_validators(self):
+        return ((validator_version('users'),
+                 relation_version(self.request.user)), None)
+
+    @conditional_get
+    def list(self, request, *args, **kwargs):
+        rows = user_values(self.filter_queryset(self.get_queryset()))
+        relations = relation_sets.get(request.user)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(
+                build_users(page, request, relations))
+        return Response(build_users(rows, request, relations))
+
+    @conditional_get
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     @action(detail=False,
             methods=['get'],
             permission_classes=[permissions.IsAuthenticated])
+    @conditional_get
     def me(self, request):
         return super().me(request, pk=request.user.pk)
 
@@ -207,6 +380,7 @@ class UserViewSet(DjoserUserViewSet):
             methods=['post', 'delete'],
             serializer_class=UserWithRecipes,
             permission_classes=[permissions.IsAuthenticated])
+    @transaction.atomic
     def subscribe(self, request, id=None):
         author = self.get_object()
         user = request.user
@@ -220,16 +394,88 @@ class UserViewSet(DjoserUserViewSet):
             if not created:
                 return Response({'detail': 'Подписка уже оформлена'},
                                 status=status.HTTP_400_BAD_REQUEST)
+            self._shift_subscription_counters(user, author, 1)
+            relation_sets.add(user.id, 'subscriptions', [author.id])
+            feed.subscribed(user, [author.id])
+            author.is_subscribed = True
             return Response(self.get_serializer(author).data,
                             status=status.HTTP_201_CREATED)
-        try:
-            Subscription.objects.get(user=user, author=author).delete()
+        if delete_returning(Subscription.objects.filter(user=user,
+                                                        author=author),
+                            'author_id'):
+            self._shift_subscription_counters(user, author, -1)
+            relation_sets.remove(user.id, 'subscriptions', [author.id])
+            feed.unsubscribed(user, [author.id])
             return Response(status=status.HTTP_204_NO_CONTENT)
-        except Subscription.DoesNotExist:
-            return Response(
-                {'detail': 'Подписка не найдена'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        return Response(
+            {'detail': 'Подписка не найдена'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    @action(detail=False,
+            methods=['post', 'delete'],
+            url_path='subscribe',
+            serializer_class=IdListSerializer,
+            permission_classes=[permissions.IsAuthenticated])
+    @transaction.atomic
+    def subscribe_bulk(self, request):
+        """Subscribe to or unsubscribe from several authors at once."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        user = request.user
+        subscribed = dict(User.objects.filter(pk__in=ids).annotate(
+            subscribed=Exists(Subscription.objects.filter(
+                user=user, author=OuterRef('pk')))
+        ).values_list('id', 'subscribed'))
+
+        if request.method == 'POST':
+            changed = insert_returning(
+                Subscription, ('user', 'author'),
+                [(user.pk, pk) for pk in ids
+                 if pk in subscribed and not subscribed[pk]
+                 and pk != user.pk],
+                returning='author')
+            delta, statuses = 1, ('subscribed', 'already_subscribed')
+        else:
+            changed = delete_returning(
+                Subscription.objects.filter(
+                    user=user,
+                    author_id__in=[pk for pk in ids if subscribed.get(pk)]),
+                'author_id')
+            delta, statuses = -1, ('unsubscribed', 'not_subscribed')
+
+        if changed:
+            User.objects.filter(pk=user.pk).update(
+                subscription_count=(F('subscription_count')
+                                    + delta * len(changed)))
+            User.objects.filter(pk__in=changed).update(
+                follower_count=F('follower_count') + delta)
+            update_relations = (relation_sets.add if delta > 0
+                                else relation_sets.remove)
+            update_relations(user.id, 'subscriptions', changed)
+            update_feed = feed.subscribed if delta > 0 else feed.unsubscribed
+            update_feed(user, changed)
+        changed = set(changed)
+
+        def get_status(pk):
+            if pk not in subscribed:
+                return 'not_found'
+            if pk in changed:
+                return statuses[0]
+            if pk == user.pk and request.method == 'POST':
+                return 'self'
+            return statuses[1]
+
+        return Response({'results': [
+            {'id': pk, 'status': get_status(pk)} for pk in ids]})
+
+    @staticmethod
+    def _shift_subscription_counters(user, author, delta):
+        User.objects.filter(pk=user.pk).update(
+            subscription_count=F('subscription_count') + delta)
+        User.objects.filter(pk=author.pk).update(
+            follower_count=F('follower_count') + delta)
 
     @action(detail=False,
             methods=['get'],
@@ -239,8 +485,18 @@ class UserViewSet(DjoserUserViewSet):
         user = request.user
         subscriptions = Subscription.objects.filter(
             user=user).values_list('author', flat=True)
+        recipes = Recipe.objects.order_by('name')
+        limit = get_recipes_limit(request)
+        if limit:
+            recipes = recipes.annotate(row_number=Window(
+                RowNumber(),
+                partition_by=F('author_id'),
+                order_by=F('name').asc(),
+            )).filter(row_number__lte=limit)
         queryset = User.objects.filter(id__in=subscriptions).annotate(
-            recipes_count=Count('recipes')
+            is_subscribed=Value(True)
+        ).prefetch_related(
+            Prefetch('recipes', queryset=recipes, to_attr='limited_recipes')
         )
 
         page = self.paginate_queryset(queryset)
@@ -254,16 +510,17 @@ class UserViewSet(DjoserUserViewSet):
             permission_classes=[permissions.IsAuthenticated])
     def avatar(self, request):
         if request.method == 'PUT':
-            serializer = self.get_serializer(data=request.data)
-            if serializer.is_valid(raise_exception=True):
-                request.user.avatar = serializer.validated_data['avatar']
-                request.user.save()
-                avatar_url = request.user.avatar.url if request.user.avatar else None
-                return Response({'avatar': avatar_url}, status=status.HTTP_200_OK)
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            serializer = self.get_serializer(request.user, data=request.data)
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+            avatar_url = (request.user.avatar.url
+                          if request.user.avatar else None)
+            return Response({'avatar': avatar_url}, status=status.HTTP_200_OK)
         elif request.method == 'DELETE':
-            if request.user.avatar:
-                request.user.avatar.delete()
+            if request.user.avatar and not is_placeholder(request.user.avatar):
+                request.user.avatar.delete(save=False)
             request.user.avatar = None
-            request.user.save()
+            request.user.avatar_variants = {}
+            request.user.save(update_fields=['avatar', 'avatar_variants',
+                                             'updated_at'])
             return Response(status=status.HTTP_204_NO_CONTENT)
@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'api.performance.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -97,6 +98,32 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Anonymous recipe responses are cached in 'responses', which also holds
+# the generations that invalidate the per-process token and relation
+# caches. Local memory is per process; point RESPONSE_CACHE_BACKEND at
+# RedisCache or FileBasedCache (with the server URL or a directory in
+# RESPONSE_CACHE_LOCATION) to share it between workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': os.environ.get(
+            'RESPONSE_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('RESPONSE_CACHE_LOCATION', 'responses'),
+        'TIMEOUT': int(os.environ.get('RESPONSE_CACHE_TIMEOUT', 60)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(
+                os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -137,22 +164,98 @@ STATIC_ROOT = BASE_DIR / 'static'
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Uploaded images are decoded and re-encoded in a pool of worker
+# processes; with WORKERS=0 they are processed in the request thread.
+IMAGE_PROCESSING = {
+    'WORKERS': int(os.environ.get('IMAGE_PROCESSING_WORKERS', 2)),
+    'QUEUE_SIZE': int(os.environ.get('IMAGE_PROCESSING_QUEUE_SIZE', 16)),
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
 }
 
 AUTH_USER_MODEL = 'recipes.User'
 
+# Ingredient autocomplete: seconds before the in-memory index is reloaded
+# from the database and the number of suggestions returned per prefix.
+INGREDIENT_INDEX_TTL = int(os.environ.get('INGREDIENT_INDEX_TTL', 300))
+INGREDIENT_SEARCH_LIMIT = int(os.environ.get('INGREDIENT_SEARCH_LIMIT', 50))
+
+# Maximum number of matches ranked by the in-process recipe search used
+# when the database has no full-text search (SQLite).
+RECIPE_SEARCH_LIMIT = int(os.environ.get('RECIPE_SEARCH_LIMIT', 500))
+
+# Ingredient filters use in-memory sorted recipe ids per ingredient, built
+# in the background. Changed recipes are applied on use, the index is
+# rebuilt every INGREDIENT_RECIPES_TTL seconds.
+INGREDIENT_RECIPES_TTL = int(os.environ.get('INGREDIENT_RECIPES_TTL', 600))
+
+# Maximum number of ids accepted by the batch favorite, shopping cart and
+# subscription endpoints.
+BULK_MAX_IDS = int(os.environ.get('BULK_MAX_IDS', 100))
+
+# Share of requests profiled by api.performance.PerformanceMiddleware
+# (SQL, view, serializer and render timings in a Server-Timing header) and
+# the duration above which a request is logged as slow.
+PERFORMANCE = {
+    'SAMPLE_RATE': float(os.environ.get('PERFORMANCE_SAMPLE_RATE', 0.05)),
+    'SLOW_REQUEST_MS': int(os.environ.get('PERFORMANCE_SLOW_REQUEST_MS',
+                                          500)),
+}
+
+# Token -> user lookups kept per process by
+# api.authentication.CachedTokenAuthentication; logout, password changes and
+# deactivation invalidate them through the response cache. Unless that cache
+# is shared, other workers only see them after LOCAL_TIMEOUT seconds.
+TOKEN_AUTH_CACHE = {
+    'MAX_ENTRIES': int(os.environ.get('TOKEN_AUTH_CACHE_MAX_ENTRIES', 10000)),
+    'TIMEOUT': int(os.environ.get('TOKEN_AUTH_CACHE_TIMEOUT', 300)),
+    'LOCAL_TIMEOUT': int(
+        os.environ.get('TOKEN_AUTH_CACHE_LOCAL_TIMEOUT', 5)),
+}
+
+# Favorite, shopping cart and subscription ids of recently active users
+# kept per process by api.relation_sets for is_favorited, is_in_shopping_cart
+# and is_subscribed. Changes reach other workers through the response cache
+# when it is shared, otherwise after LOCAL_TIMEOUT seconds.
+RELATION_SET_CACHE = {
+    'MAX_USERS': int(os.environ.get('RELATION_SET_CACHE_MAX_USERS', 10000)),
+    'TIMEOUT': int(os.environ.get('RELATION_SET_CACHE_TIMEOUT', 600)),
+    'LOCAL_TIMEOUT': int(
+        os.environ.get('RELATION_SET_CACHE_LOCAL_TIMEOUT', 5)),
+}
+
+# Subscription feed: recipes are copied to followers' feeds in batches of
+# BATCH_SIZE by FANOUT_WORKERS background threads (0 inserts them before the
+# response) unless the author has FANOUT_MAX_FOLLOWERS followers or more;
+# those are read at request time. A new subscription copies up to
+# BACKFILL_LIMIT latest recipes of the author.
+FEED = {
+    'FANOUT_MAX_FOLLOWERS': int(os.environ.get('FEED_FANOUT_MAX_FOLLOWERS',
+                                               10000)),
+    'BATCH_SIZE': int(os.environ.get('FEED_BATCH_SIZE', 1000)),
+    'BACKFILL_LIMIT': int(os.environ.get('FEED_BACKFILL_LIMIT', 500)),
+    'FANOUT_WORKERS': int(os.environ.get('FEED_FANOUT_WORKERS', 1)),
+}
+
+# TTF font with Cyrillic glyphs used for the PDF shopping list.
+SHOPPING_LIST_PDF_FONT = os.environ.get('SHOPPING_LIST_PDF_FONT')
+
 DJOSER = {
     'LOGIN_FIELD': 'email',
     'SERIALIZERS': {
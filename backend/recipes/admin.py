@@ -1,39 +1,78 @@
 from django.contrib import admin
 from .models import Ingredient, IngredientInRecipe, Recipe, Favorite, ShoppingCart
 from django.utils.safestring import mark_safe
+from django.core.files.storage import default_storage
 from django.contrib.auth import get_user_model
 from .filters import CookingTimeFilter, HasSubscriptionsFilter, HasFollowersFilter
 from django.contrib.auth.admin import UserAdmin
-from django.db.models import Count
+from django.contrib.postgres.search import SearchQuery
+from django.db import connection
+from django.db.models import Prefetch, Q
+from .models import SEARCH_CONFIG
+from .counters import recount_on_commit
 
 
 User = get_user_model()
 
 
+class RecountCountersMixin:
+    """Recount the counters an admin add, change or delete affects.
+
+    recount_fields names the foreign keys to the rows with the counters.
+    """
+
+    recount_fields = ()
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.recount([obj], form.initial)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.recount([obj])
+
+    def delete_queryset(self, request, queryset):
+        objs = list(queryset)
+        super().delete_queryset(request, queryset)
+        self.recount(objs)
+
+    def recount(self, objs, initial=None):
+        for field_name in self.recount_fields:
+            field = self.model._meta.get_field(field_name)
+            pks = {getattr(obj, field.attname) for obj in objs}
+            if initial:
+                pks.add(initial.get(field_name))
+            recount_on_commit(field.related_model, pks)
+
+
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
     list_display = ('name',
                     'measurement_unit',
-                    'recipe_count')
+                    'recipes_count')
     search_fields = ('name',
                      'measurement_unit')
     list_filter = ('measurement_unit',)
 
-    @admin.display(description='Рецептов')
-    def recipe_count(self, ingredient):
-        return ingredient.ingredients_in_recipe.count()
-
 
 class IngredientInRecipeInline(admin.TabularInline):
     model = IngredientInRecipe
     extra = 1
+    autocomplete_fields = ('ingredient',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('ingredient')
 
 
 @admin.register(IngredientInRecipe)
-class IngredientInRecipeAdmin(admin.ModelAdmin):
+class IngredientInRecipeAdmin(RecountCountersMixin, admin.ModelAdmin):
+    recount_fields = ('ingredient',)
     list_display = ('recipe',
                     'ingredient',
                     'amount')
+    list_select_related = ('recipe', 'ingredient')
+    autocomplete_fields = ('recipe', 'ingredient')
+    show_full_result_count = False
 
 
 @admin.register(Recipe)
@@ -54,10 +93,39 @@ class RecipeAdmin(admin.ModelAdmin):
                      'author__first_name',
                      'author__last_name')
     readonly_fields = ('favorites_count',)
+    list_select_related = ('author',)
+    autocomplete_fields = ('author',)
+    show_full_result_count = False
 
-    @admin.display(description='Добавлено в избранное')
-    def favorites_count(self, recipe):
-        return recipe.favorites.count()
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('ingredients_in_recipe',
+                     queryset=IngredientInRecipe.objects.select_related(
+                         'ingredient').order_by('id')))
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Deleting a recipe recounts through recipes.counters.
+        recount_on_commit(User, [form.initial.get('author'),
+                                 form.instance.author_id])
+        recount_on_commit(Ingredient, [
+            ingredient_id
+            for formset in formsets
+            for inline_form in formset.forms
+            for ingredient_id in (inline_form.initial.get('ingredient'),
+                                  inline_form.instance.ingredient_id)])
+
+    def get_search_results(self, request, queryset, search_term):
+        if connection.vendor != 'postgresql' or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        # Name and description go through the GIN indexed search vector
+        # instead of ILIKE scans.
+        query = SearchQuery(search_term, config=SEARCH_CONFIG,
+                            search_type='websearch')
+        author_lookups = Q()
+        for field in ('username', 'first_name', 'last_name'):
+            author_lookups |= Q(**{f'author__{field}__icontains': search_term})
+        return queryset.filter(Q(search_vector=query) | author_lookups), False
 
     @admin.display(description='Продукты')
     @mark_safe
@@ -68,15 +136,23 @@ class RecipeAdmin(admin.ModelAdmin):
     @admin.display(description='Картинка')
     @mark_safe
     def recipe_image(self, recipe):
+        thumb = recipe.image_variants.get('thumb')
+        if thumb:
+            return (f'<img src="{default_storage.url(thumb["jpeg"])}" '
+                    'width="50" height="50" />')
         if recipe.image:
             return f'<img src="{recipe.image.url}" width="50" height="50" />'
         return ""
 
 
 @admin.register(Favorite, ShoppingCart)
-class FavoriteOrShoppingCartAdmin(admin.ModelAdmin):
+class FavoriteOrShoppingCartAdmin(RecountCountersMixin, admin.ModelAdmin):
+    recount_fields = ('recipe',)
     list_display = ('user',
                     'recipe')
+    list_select_related = ('user', 'recipe')
+    autocomplete_fields = ('user', 'recipe')
+    show_full_result_count = False
 
 
 @admin.register(User)
@@ -85,8 +161,8 @@ class UserAdminExtended(UserAdmin):
                     'username',
                     'full_name',
                     'email',
-                    'avatar', ''
-                    'recipe_count',
+                    'avatar',
+                    'recipes_count',
                     'subscription_count',
                     'follower_count')
     search_fields = ('username',
@@ -103,22 +179,14 @@ class UserAdminExtended(UserAdmin):
     @admin.display(description='Аватар')
     @mark_safe
     def avatar(self, user):
+        thumb = user.avatar_variants.get('thumb')
+        if thumb:
+            return (f'<img src="{default_storage.url(thumb["jpeg"])}" '
+                    'width="50" height="50" />')
         if user.avatar:
             return f'<img src="{user.avatar.url}" width="50" height="50" />'
         return "Нет аватара"
 
-    @admin.display(description='Рецептов')
-    def recipe_count(self, user):
-        return user.recipe_count
-
-    @admin.display(description='Подписок')
-    def subscription_count(self, user):
-        return user.subscription_count
-
-    @admin.display(description='Подписчиков')
-    def follower_count(self, user):
-        return user.follower_count
-
     @admin.display(description='Есть подписки', boolean=True)
     def has_subscriptions(self, user):
         return user.subscriptions.exists()
@@ -126,12 +194,3 @@ class UserAdminExtended(UserAdmin):
     @admin.display(description='Есть подписчики', boolean=True)
     def has_followers(self, user):
         return user.authors.exists()
-
-    def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-        queryset = queryset.annotate(
-            recipe_count=Count('recipes', distinct=True),
-            subscription_count=Count('subscriptions', distinct=True),
-            follower_count=Count('authors', distinct=True)
-        )
-        return queryset
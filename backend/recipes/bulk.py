@@ -0,0 +1,145 @@
+import io
+import json
+
+from django.db import connection, models, transaction
+
+
+def copy_value(field, value):
+    """Format a field value for COPY ... FROM STDIN in text format."""
+    if value is None:
+        return r'\N'
+    if isinstance(field, models.JSONField):
+        value = json.dumps(value, ensure_ascii=False)
+    else:
+        value = field.get_db_prep_save(value, connection)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_from(cursor, sql, buffer):
+    raw_cursor = cursor.cursor
+    if hasattr(raw_cursor, 'copy_expert'):
+        raw_cursor.copy_expert(sql, buffer)
+    else:
+        with raw_cursor.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+def copy_rows(model, field_names, rows):
+    """Insert rows with COPY, skipping rows that violate a constraint.
+
+    Rows are tuples of values for field_names; the other columns (except
+    an omitted primary key) get the field defaults. Rows are copied into
+    a temporary table first and moved with INSERT ... ON CONFLICT DO
+    NOTHING. Returns the number of inserted rows.
+    """
+    meta = model._meta
+    given = [meta.get_field(name) for name in field_names]
+    template = model()
+    missing = [field for field in meta.concrete_fields
+               if field not in given and not field.primary_key]
+    defaults = ''.join(
+        '\t' + copy_value(field, field.pre_save(template, add=True))
+        for field in missing)
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(
+            copy_value(field, value) for field, value in zip(given, row)))
+        buffer.write(defaults)
+        buffer.write('\n')
+    if not buffer.tell():
+        return 0
+    buffer.seek(0)
+
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+    temp_table = quote(f'import_{meta.db_table}')
+    columns = ', '.join(quote(field.column) for field in given + missing)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TEMP TABLE {temp_table} ON COMMIT DROP AS '
+            f'SELECT {columns} FROM {table} WITH NO DATA')
+        copy_from(cursor, f'COPY {temp_table} ({columns}) FROM STDIN',
+                  buffer)
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) '
+            f'SELECT {columns} FROM {temp_table} ON CONFLICT DO NOTHING')
+        inserted = cursor.rowcount
+        cursor.execute(f'DROP TABLE {temp_table}')
+    return inserted
+
+
+def copy_insert(model, objs):
+    """Insert objects with COPY; primary keys are copied when set."""
+    if not objs:
+        return 0
+    fields = [field for field in model._meta.concrete_fields
+              if not field.primary_key or objs[0].pk is not None]
+    return copy_rows(model, [field.attname for field in fields], (
+        [field.pre_save(obj, add=True) for field in fields] for obj in objs))
+
+
+def bulk_insert(model, objs):
+    """Insert a batch of objects as fast as the database allows.
+
+    Uses COPY on PostgreSQL and bulk_create(ignore_conflicts=True)
+    elsewhere, where the number of inserted rows is not known and the
+    batch size is returned instead.
+    """
+    if connection.vendor == 'postgresql':
+        return copy_insert(model, objs)
+    model.objects.bulk_create(objs, ignore_conflicts=True)
+    return len(objs)
+
+
+def bulk_insert_rows(model, field_names, rows):
+    """Insert tuples of field values; no instances are built for COPY."""
+    if connection.vendor == 'postgresql':
+        return copy_rows(model, field_names, rows)
+    return bulk_insert(model, [model(**dict(zip(field_names, row)))
+                               for row in rows])
+
+
+def insert_returning(model, field_names, rows, returning):
+    """INSERT ... ON CONFLICT DO NOTHING, returning a column of new rows.
+
+    Rows skipped because they already exist, for instance inserted by a
+    concurrent transaction, are not returned. Without RETURNING support
+    every row is reported as inserted.
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    if not connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(
+            [model(**dict(zip(field_names, row))) for row in rows],
+            ignore_conflicts=True)
+        return [row[field_names.index(returning)] for row in rows]
+
+    meta = model._meta
+    quote = connection.ops.quote_name
+    fields = [meta.get_field(name) for name in field_names]
+    columns = ', '.join(quote(field.column) for field in fields)
+    placeholders = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {quote(meta.db_table)} ({columns}) '
+            f'VALUES {", ".join([placeholders] * len(rows))} '
+            f'ON CONFLICT DO NOTHING '
+            f'RETURNING {quote(meta.get_field(returning).column)}',
+            [field.get_db_prep_save(value, connection)
+             for row in rows for field, value in zip(fields, row)])
+        return [value for value, in cursor.fetchall()]
+
+
+def delete_returning(queryset, field_name):
+    """Delete the rows of a queryset, returning field_name of each of them.
+
+    The rows are locked first, so a row a concurrent transaction deleted
+    meanwhile is not returned by both. Must run in a transaction.
+    """
+    values = list(queryset.select_for_update().values_list(
+        field_name, flat=True))
+    if values:
+        queryset.filter(**{f'{field_name}__in': values}).delete()
+    return values
@@ -0,0 +1,70 @@
+"""Recounting of the denormalised counters.
+
+The API shifts the counters with F() updates as it changes related
+rows. Changes it does not make itself, admin edits and cascading
+deletes, recount the affected rows from the data once they commit.
+"""
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
+                     ShoppingCart, Subscription, User)
+
+
+COUNTERS = (
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'subscription_count', Subscription, 'user'),
+    (User, 'follower_count', Subscription, 'author'),
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'cart_count', ShoppingCart, 'recipe'),
+    (Ingredient, 'recipes_count', IngredientInRecipe, 'ingredient'),
+)
+
+
+def actual_count(related_model, related_field):
+    return Coalesce(Subquery(
+        related_model.objects.filter(**{related_field: OuterRef('pk')})
+        .order_by()
+        .values(related_field)
+        .annotate(count=Count('pk'))
+        .values('count')
+    ), 0)
+
+
+def recount(model, pks):
+    """Set every counter of the given rows to its actual value."""
+    pks = set(pks) - {None}
+    if pks:
+        model.objects.filter(pk__in=pks).update(**{
+            field: actual_count(related_model, related_field)
+            for counter_model, field, related_model, related_field
+            in COUNTERS if counter_model is model})
+
+
+def recount_on_commit(model, pks):
+    pks = set(pks)
+    transaction.on_commit(lambda: recount(model, pks))
+
+
+@receiver(pre_delete, sender=Recipe)
+def recount_for_deleted_recipe(instance, **kwargs):
+    recount_on_commit(User, [instance.author_id])
+    recount_on_commit(Ingredient, IngredientInRecipe.objects.filter(
+        recipe=instance).values_list('ingredient_id', flat=True))
+
+
+@receiver(pre_delete, sender=User)
+def recount_for_deleted_user(instance, **kwargs):
+    # Recipes of the user send their own pre_delete.
+    subscriptions = Subscription.objects.filter(
+        Q(user=instance) | Q(author=instance)).values_list(
+            'user_id', 'author_id')
+    recount_on_commit(User, {pk for pair in subscriptions for pk in pair})
+    recount_on_commit(Recipe, [
+        *Favorite.objects.filter(user=instance).values_list(
+            'recipe_id', flat=True),
+        *ShoppingCart.objects.filter(user=instance).values_list(
+            'recipe_id', flat=True)])
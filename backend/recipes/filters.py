@@ -1,4 +1,73 @@
 from django.contrib.admin import SimpleListFilter
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Recipe
+
+
+THRESHOLDS_CACHE_KEY = 'admin:cooking_time_thresholds'
+THRESHOLDS_CACHE_TIMEOUT = 600
+
+
+def cooking_time_terciles():
+    """Terciles of the distinct cooking times, None for fewer than 3.
+
+    The thresholds are the distinct times at positions len // 3 and
+    2 * len // 3 of the sorted list. Postgres picks them with
+    percentile_disc, aiming at the middle of each position so rounding
+    cannot move to a neighbour; elsewhere they are read with OFFSET.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'WITH times AS (SELECT DISTINCT cooking_time FROM '
+                f'{connection.ops.quote_name(Recipe._meta.db_table)}), '
+                'total AS (SELECT count(*) AS n FROM times) '
+                'SELECT n, percentile_disc(ARRAY['
+                '(n / 3 + 0.5) / n, (2 * n / 3 + 0.5) / n]::float8[]) '
+                'WITHIN GROUP (ORDER BY cooking_time) '
+                'FROM times, total GROUP BY n')
+            row = cursor.fetchone()
+        if row is None or row[0] < 3:
+            return None
+        return tuple(row[1])
+
+    times = Recipe.objects.order_by('cooking_time').values_list(
+        'cooking_time', flat=True).distinct()
+    count = times.count()
+    if count < 3:
+        return None
+    return times[count // 3], times[2 * count // 3]
+
+
+def cooking_time_ranges():
+    """Thresholds and per-range recipe counts, cached until recipes change."""
+    ranges = cache.get(THRESHOLDS_CACHE_KEY)
+    if ranges is not None:
+        return ranges
+
+    thresholds = cooking_time_terciles()
+    ranges = {'thresholds': thresholds}
+    if thresholds is not None:
+        n, m = thresholds
+        ranges['counts'] = Recipe.objects.aggregate(
+            fast=Count('pk', filter=Q(cooking_time__lt=n)),
+            medium=Count('pk', filter=Q(cooking_time__gte=n,
+                                        cooking_time__lt=m)),
+            long=Count('pk', filter=Q(cooking_time__gte=m)),
+        )
+    cache.set(THRESHOLDS_CACHE_KEY, ranges, THRESHOLDS_CACHE_TIMEOUT)
+    return ranges
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def invalidate_cooking_time_ranges(update_fields=None, **kwargs):
+    if update_fields is None or 'cooking_time' in update_fields:
+        transaction.on_commit(lambda: cache.delete(THRESHOLDS_CACHE_KEY))
 
 
 class CookingTimeFilter(SimpleListFilter):
@@ -6,35 +75,19 @@ class CookingTimeFilter(SimpleListFilter):
     parameter_name = 'cooking_time_range'
     thresholds = None
 
-    def calculate_thresholds(self, queryset):
-        all_times = sorted(queryset.values_list(
-            'cooking_time', flat=True).distinct())
-        if len(all_times) < 3:
-            return None
-
-        n = all_times[len(all_times) // 3]
-        m = all_times[2 * len(all_times) // 3]
-        return n, m
-
     def lookups(self, request, model_admin):
-        if self.thresholds is None:
-            queryset = model_admin.model.objects.all()
-            self.thresholds = self.calculate_thresholds(queryset)
-
+        ranges = cooking_time_ranges()
+        self.thresholds = ranges['thresholds']
         if self.thresholds is None:
             return []
 
         n, m = self.thresholds
-
-        less_than_n_count = queryset.filter(cooking_time__lt=n).count()
-        between_n_m_count = queryset.filter(
-            cooking_time__gte=n, cooking_time__lt=m).count()
-        greater_than_m_count = queryset.filter(cooking_time__gte=m).count()
+        counts = ranges['counts']
 
         return (
-            ('fast', f'Быстрее {n} мин ({less_than_n_count})'),
-            ('medium', f'От {n} до {m} мин ({between_n_m_count})'),
-            ('long', f'Более {m} мин ({greater_than_m_count})'),
+            ('fast', f'Быстрее {n} мин ({counts["fast"]})'),
+            ('medium', f'От {n} до {m} мин ({counts["medium"]})'),
+            ('long', f'Более {m} мин ({counts["long"]})'),
         )
 
     def queryset(self, request, queryset):
@@ -53,10 +106,12 @@ class CookingTimeFilter(SimpleListFilter):
         return queryset
 
 
-class BooleanListFilter(SimpleListFilter):
+class CounterListFilter(SimpleListFilter):
+    """Yes/no filter on a denormalised counter of the model."""
+
     title = 'Boolean Filter'
     parameter_name = 'boolean_filter'
-    field_name = None
+    counter_field = None
     lookup_choices = (
         ('yes', 'Да'),
         ('no', 'Нет'),
@@ -67,19 +122,19 @@ class BooleanListFilter(SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == 'yes':
-            return queryset.filter(**{f'{self.field_name}__isnull': False}).distinct()
+            return queryset.filter(**{f'{self.counter_field}__gt': 0})
         if self.value() == 'no':
-            return queryset.filter(**{f'{self.field_name}__isnull': True})
+            return queryset.filter(**{self.counter_field: 0})
         return queryset
 
 
-class HasSubscriptionsFilter(BooleanListFilter):
+class HasSubscriptionsFilter(CounterListFilter):
     title = 'Есть подписки'
     parameter_name = 'has_subscriptions'
-    field_name = 'subscriptions'
+    counter_field = 'subscription_count'
 
 
-class HasFollowersFilter(BooleanListFilter):
+class HasFollowersFilter(CounterListFilter):
     title = 'Есть подписчики'
     parameter_name = 'has_followers'
-    field_name = 'authors'
+    counter_field = 'follower_count'
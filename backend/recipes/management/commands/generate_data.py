@@ -0,0 +1,261 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
+from ...bulk import bulk_insert_rows
+from ...models import (Favorite, Ingredient, IngredientInRecipe, Recipe,
+                       ShoppingCart, Subscription, User,
+                       recipe_search_vector)
+
+
+FIRST_NAMES = ('Анна', 'Иван', 'Мария', 'Пётр', 'Ольга', 'Сергей',
+               'Елена', 'Дмитрий', 'Наталья', 'Алексей')
+LAST_NAMES = ('Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев',
+              'Соколов', 'Михайлов', 'Новиков', 'Фёдоров', 'Морозов')
+ADJECTIVES = ('Домашний', 'Быстрый', 'Летний', 'Пряный', 'Нежный',
+              'Сытный', 'Лёгкий', 'Острый', 'Праздничный', 'Бабушкин')
+DISHES = ('суп', 'салат', 'пирог', 'омлет', 'плов', 'рагу', 'соус',
+          'десерт', 'гуляш', 'борщ', 'кекс', 'паштет')
+WORDS = ('нарезать', 'обжарить', 'добавить', 'смешать', 'запекать',
+         'варить', 'посолить', 'подавать', 'горячим', 'минут', 'до',
+         'готовности', 'на', 'медленном', 'огне', 'с', 'зеленью')
+IMAGE = 'recipes/images/generated.jpg'
+PERMUTATION_PRIME = 1000003
+
+
+@lru_cache(maxsize=None)
+def cumulative_weights(size, skew):
+    """Zipf weights: the item of rank r is picked ~ 1 / r ** skew."""
+    return list(accumulate(1 / rank ** skew for rank in range(1, size + 1)))
+
+
+def pick(rng, first_id, size, skew, count):
+    """Pick ids in [first_id, first_id + size) with a power-law skew.
+
+    Ranks are spread over the id range with a fixed permutation, so the
+    most popular objects are not simply the oldest ones.
+    """
+    step = PERMUTATION_PRIME if math.gcd(PERMUTATION_PRIME, size) == 1 else 1
+    ranks = rng.choices(range(size), cum_weights=cumulative_weights(
+        size, skew), k=count)
+    return [first_id + rank * step % size for rank in ranks]
+
+
+def sample_count(rng, mean, limit):
+    if mean <= 0:
+        return 0
+    return min(int(rng.expovariate(1 / mean)), limit)
+
+
+def chunk_rng(seed, table, start):
+    # Every chunk has its own generator, so the data does not depend on
+    # the number of workers or the order chunks finish in.
+    return random.Random(f'{seed}:{table}:{start}')  # nosec B311
+
+
+def generate_users(start, stop, plan):
+    rng = chunk_rng(plan['seed'], 'users', start)
+    return bulk_insert_rows(
+        User,
+        ('id', 'username', 'email', 'first_name', 'last_name', 'password'),
+        [(user_id, f'user{user_id}', f'user{user_id}@example.com',
+          rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), plan['password'])
+         for user_id in range(start, stop)])
+
+
+def generate_recipes(start, stop, plan):
+    rng = chunk_rng(plan['seed'], 'recipes', start)
+    users, ingredients = plan['users'], plan['ingredients']
+    authors = pick(rng, users['first'], users['size'], plan['skew'],
+                   stop - start)
+    recipes, recipe_ingredients = [], []
+    for recipe_id, author_id in zip(range(start, stop), authors):
+        recipes.append((
+            recipe_id,
+            author_id,
+            f'{rng.choice(ADJECTIVES)} {rng.choice(DISHES)} №{recipe_id}',
+            IMAGE,
+            ' '.join(rng.choices(WORDS, k=rng.randint(8, 30))),
+            rng.randint(5, 180)))
+        count = rng.randint(*plan['ingredients_per_recipe'])
+        for index in set(pick(rng, 0, len(ingredients), plan['skew'],
+                              count)):
+            recipe_ingredients.append(
+                (recipe_id, ingredients[index], rng.randint(1, 500)))
+    inserted = bulk_insert_rows(
+        Recipe,
+        ('id', 'author_id', 'name', 'image', 'text', 'cooking_time'),
+        recipes)
+    if connection.vendor == 'postgresql':
+        Recipe.objects.filter(id__range=(start, stop - 1)).update(
+            search_vector=recipe_search_vector())
+    bulk_insert_rows(IngredientInRecipe,
+                     ('recipe_id', 'ingredient_id', 'amount'),
+                     recipe_ingredients)
+    return inserted
+
+
+def generate_relations(start, stop, plan):
+    """Favorites, cart items and subscriptions of a range of users."""
+    rng = chunk_rng(plan['seed'], 'relations', start)
+    users, recipes = plan['users'], plan['recipes']
+    rows = {Favorite: [], ShoppingCart: [], Subscription: []}
+    fields = {Favorite: ('user_id', 'recipe_id'),
+              ShoppingCart: ('user_id', 'recipe_id'),
+              Subscription: ('user_id', 'author_id')}
+    for user_id in range(start, stop):
+        for model, mean in ((Favorite, plan['favorites']),
+                            (ShoppingCart, plan['carts'])):
+            count = sample_count(rng, mean, recipes['size'])
+            for recipe_id in set(pick(rng, recipes['first'], recipes['size'],
+                                      plan['skew'], count)):
+                rows[model].append((user_id, recipe_id))
+        count = sample_count(rng, plan['subscriptions'], users['size'])
+        for author_id in set(pick(rng, users['first'], users['size'],
+                                  plan['skew'], count)) - {user_id}:
+            rows[Subscription].append((user_id, author_id))
+    return sum(bulk_insert_rows(model, fields[model], model_rows)
+               for model, model_rows in rows.items())
+
+
+class Command(BaseCommand):
+    help = ('Generates a large reproducible dataset of users, recipes and '
+            'their relations for benchmarks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument(
+            '--ingredients-per-recipe',
+            type=int,
+            nargs=2,
+            default=(3, 15),
+            metavar=('MIN', 'MAX'),
+        )
+        parser.add_argument(
+            '--favorites',
+            type=float,
+            default=10,
+            help='Mean favorites per user',
+        )
+        parser.add_argument(
+            '--carts',
+            type=float,
+            default=3,
+            help='Mean shopping cart recipes per user',
+        )
+        parser.add_argument(
+            '--subscriptions',
+            type=float,
+            default=5,
+            help='Mean subscriptions per user',
+        )
+        parser.add_argument(
+            '--skew',
+            type=float,
+            default=1.1,
+            help='Power-law exponent of recipe, author and ingredient '
+                 'popularity',
+        )
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Parallel insert processes (PostgreSQL only)',
+        )
+        parser.add_argument(
+            '--password',
+            default='password',
+            help='Password of every generated user',
+        )
+        parser.add_argument(
+            '--ingredients',
+            help='Ingredient catalogue to load first when the table is '
+                 'empty (defaults to the load_data lookup)',
+        )
+
+    def handle(self, *args, **options):
+        if options['users'] <= 0 or options['recipes'] <= 0:
+            raise CommandError('--users and --recipes must be positive')
+        if not Ingredient.objects.exists():
+            call_command('load_data', ingredients=options['ingredients'],
+                         stdout=self.stdout)
+        ingredients = list(Ingredient.objects.order_by('id').values_list(
+            'id', flat=True))
+        if not ingredients:
+            raise CommandError('The ingredient catalogue is empty')
+
+        low, high = options['ingredients_per_recipe']
+        first_user = (User.objects.aggregate(id=Max('id'))['id'] or 0) + 1
+        first_recipe = (Recipe.objects.aggregate(id=Max('id'))['id'] or 0) + 1
+        plan = {
+            'seed': options['seed'],
+            'skew': options['skew'],
+            'password': make_password(options['password']),
+            'ingredients': ingredients,
+            'ingredients_per_recipe': (min(low, high), max(low, high)),
+            'users': {'first': first_user, 'size': options['users']},
+            'recipes': {'first': first_recipe, 'size': options['recipes']},
+            'favorites': options['favorites'],
+            'carts': options['carts'],
+            'subscriptions': options['subscriptions'],
+        }
+
+        workers = max(options['workers'] or 1, 1)
+        if connection.vendor != 'postgresql':
+            workers = 1
+        executor = None
+        if workers > 1:
+            connection.close()
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup)
+        try:
+            batch_size = max(options['batch_size'], 1)
+            self.run(executor, 'users', generate_users,
+                     first_user, options['users'], batch_size, plan)
+            self.run(executor, 'recipes', generate_recipes,
+                     first_recipe, options['recipes'], batch_size, plan)
+            self.run(executor, 'relations', generate_relations,
+                     first_user, options['users'],
+                     max(batch_size // 10, 1), plan)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [User, Recipe]):
+                cursor.execute(sql)
+        call_command('reconcile_counters', stdout=self.stdout)
+        call_command('rebuild_shopping_lists', stdout=self.stdout)
+        call_command('rebuild_feeds', stdout=self.stdout)
+
+    def run(self, executor, table, generate, first_id, size, batch_size,
+            plan):
+        started = time.perf_counter()
+        chunks = [(start, min(start + batch_size, first_id + size), plan)
+                  for start in range(first_id, first_id + size, batch_size)]
+        if executor is None:
+            rows = sum(generate(*chunk) for chunk in chunks)
+        else:
+            rows = sum(executor.map(generate, *zip(*chunks)))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{table}: {rows} rows in {elapsed:.2f}s '
+            f'({rows / max(elapsed, 1e-9):.0f} rows/s)'))
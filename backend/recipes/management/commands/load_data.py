@@ -1,37 +1,226 @@
-from django.core.management.base import BaseCommand
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from itertools import islice
 import json
-from ...models import Ingredient
+import multiprocessing
 import os
+import time
+
+import django
 from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from ...bulk import bulk_insert
+from ...models import (Ingredient, IngredientInRecipe, Recipe, User,
+                       recipe_search_vector)
+
+
+CHUNK_SIZE = 1 << 16
+CSV_COLUMNS = {
+    'ingredients': ('name', 'measurement_unit'),
+    'users': ('username', 'email', 'password', 'first_name', 'last_name'),
+}
+USER_FIELDS = ('username', 'email', 'first_name', 'last_name',
+               'is_staff', 'is_superuser')
+
+
+def iter_json_array(file):
+    """Yield the items of a top-level JSON array without loading it whole."""
+    decoder = json.JSONDecoder()
+    buffer = file.read(CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array')
+    buffer = buffer[1:]
+    eof = False
+    while True:
+        buffer = buffer.lstrip().removeprefix(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer += chunk
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+def iter_rows(path, dataset):
+    with open(path, encoding='utf-8', newline='') as file:
+        if path.endswith('.csv'):
+            columns = CSV_COLUMNS.get(dataset)
+            if columns is None:
+                raise CommandError(f'{dataset} cannot be loaded from CSV')
+            for row in csv.reader(file):
+                yield dict(zip(columns, row))
+        else:
+            yield from iter_json_array(file)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def hash_passwords(passwords):
+    return [make_password(password) for password in passwords]
 
 
 class Command(BaseCommand):
-    help = 'Loads ingredients from JSON file into the database'
+    help = ('Streams ingredients, users and recipes from JSON or CSV files '
+            'into the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ingredients',
+            help='Path to ingredients.json or ingredients.csv',
+        )
+        parser.add_argument(
+            '--users',
+            help='Path to users.json or users.csv',
+        )
+        parser.add_argument(
+            '--recipes',
+            help='Path to recipes.json',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows inserted per statement',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Processes hashing user passwords (0 hashes inline)',
+        )
 
     def handle(self, *args, **options):
+        self.batch_size = max(options['batch_size'], 1)
+        self.workers = max(options['workers'] or 0, 0)
+        paths = {dataset: options[dataset]
+                 for dataset in ('ingredients', 'users', 'recipes')
+                 if options[dataset]}
         try:
-            project_root = settings.BASE_DIR
-            possible_paths = [
-                os.path.join(project_root, 'ingredients.json'),
-                os.path.join(project_root, '..', 'data', 'ingredients.json'),
-            ]
-
-            for file_path in possible_paths:
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        created = Ingredient.objects.bulk_create(
-                            [Ingredient(**item) for item in json.load(file)],
-                            ignore_conflicts=True)
-                        self.stdout.write(self.style.SUCCESS(
-                            f'Created {len(created)} new ingredients'))
-                        break
-                except FileNotFoundError:
-                    continue
-            else:
-                raise FileNotFoundError(
-                    f'File not found in any of the specified paths')
-
+            if not paths:
+                paths['ingredients'] = self.default_ingredients_path()
+            for dataset, path in paths.items():
+                loader = getattr(self, f'load_{dataset}')
+                started = time.perf_counter()
+                rows, inserted = loader(path)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(self.style.SUCCESS(
+                    f'{dataset}: read {rows} rows, inserted {inserted} '
+                    f'in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} '
+                    f'rows/s)'))
+            if 'recipes' in paths:
+                call_command('reconcile_counters', stdout=self.stdout)
         except Exception as e:
             self.stdout.write(self.style.ERROR(
-                f'An error occurred ingredients.json: {e}'
+                f'An error occurred while loading data: {e}'
             ))
+
+    def default_ingredients_path(self):
+        project_root = settings.BASE_DIR
+        possible_paths = [
+            os.path.join(project_root, 'ingredients.json'),
+            os.path.join(project_root, '..', 'data', 'ingredients.json'),
+        ]
+        for file_path in possible_paths:
+            if os.path.exists(file_path):
+                return file_path
+        raise FileNotFoundError(
+            'File not found in any of the specified paths')
+
+    def load_ingredients(self, path):
+        rows = inserted = 0
+        for batch in batched(iter_rows(path, 'ingredients'), self.batch_size):
+            rows += len(batch)
+            inserted += bulk_insert(Ingredient, [
+                Ingredient(name=item['name'],
+                           measurement_unit=item['measurement_unit'])
+                for item in batch])
+        return rows, inserted
+
+    def load_users(self, path):
+        rows = inserted = 0
+        executor = None
+        if self.workers:
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup)
+        try:
+            for batch in batched(iter_rows(path, 'users'), self.batch_size):
+                rows += len(batch)
+                passwords = [item.get('password') for item in batch]
+                if executor is None:
+                    hashed = hash_passwords(passwords)
+                else:
+                    chunk = -(-len(passwords) // self.workers)
+                    hashed = [
+                        password
+                        for part in executor.map(hash_passwords,
+                                                 batched(passwords, chunk))
+                        for password in part]
+                inserted += bulk_insert(User, [
+                    User(password=password,
+                         **{field: item[field]
+                            for field in USER_FIELDS if field in item})
+                    for item, password in zip(batch, hashed)])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return rows, inserted
+
+    def load_recipes(self, path):
+        authors = dict(User.objects.values_list('username', 'id'))
+        ingredients = dict(Ingredient.objects.values_list('name', 'id'))
+        existing = set(Recipe.objects.values_list('author_id', 'name'))
+        rows = inserted = skipped = 0
+        for batch in batched(iter_rows(path, 'recipes'), self.batch_size):
+            rows += len(batch)
+            recipes, recipe_ingredients = [], []
+            for item in batch:
+                author_id = authors.get(item['author'])
+                key = (author_id, item['name'])
+                if author_id is None or key in existing:
+                    skipped += 1
+                    continue
+                existing.add(key)
+                recipes.append(Recipe(
+                    author_id=author_id,
+                    name=item['name'],
+                    image=item.get('image', ''),
+                    text=item.get('text', ''),
+                    cooking_time=item['cooking_time']))
+                recipe_ingredients.append({
+                    ingredients[ingredient['name']]: ingredient['amount']
+                    for ingredient in item.get('ingredients', ())
+                    if ingredient['name'] in ingredients})
+            with transaction.atomic():
+                Recipe.objects.bulk_create(recipes)
+                if connection.vendor == 'postgresql':
+                    Recipe.objects.filter(
+                        pk__in=[recipe.id for recipe in recipes]
+                    ).update(search_vector=recipe_search_vector())
+                bulk_insert(IngredientInRecipe, [
+                    IngredientInRecipe(recipe_id=recipe.id,
+                                       ingredient_id=ingredient_id,
+                                       amount=amount)
+                    for recipe, amounts in zip(recipes, recipe_ingredients)
+                    for ingredient_id, amount in amounts.items()])
+            inserted += len(recipes)
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'recipes: skipped {skipped} existing recipes or recipes '
+                f'with an unknown author'))
+        return rows, inserted
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...models import FeedEntry
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the subscription feeds, e.g. after bulk loads or '
+            'authors dropping below the fan-out threshold')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+        )
+        parser.add_argument(
+            '--max-followers',
+            type=int,
+            default=settings.FEED['FANOUT_MAX_FOLLOWERS'],
+            help='Authors with this many followers are read at request '
+                 'time instead of being copied to the feeds',
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        FeedEntry.objects.all().delete()
+        created = 0
+        batch = []
+        for user_id, recipe_id in FeedEntry.objects.expected(
+                options['max_followers']).iterator():
+            batch.append(FeedEntry(user_id=user_id, recipe_id=recipe_id))
+            if len(batch) >= batch_size:
+                created += len(FeedEntry.objects.bulk_create(batch))
+                batch = []
+        created += len(FeedEntry.objects.bulk_create(batch))
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {created} feed entries'))
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from ...models import ShoppingListItem
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds or verifies the aggregated per-user shopping lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Only compare stored shopping lists with the carts',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify()
+        else:
+            self.rebuild(options['batch_size'])
+
+    def verify(self):
+        expected = {
+            (user_id, ingredient_id): (total_amount, recipe_count)
+            for user_id, ingredient_id, total_amount, recipe_count
+            in ShoppingListItem.objects.expected().iterator()
+        }
+        stored = {
+            (user_id, ingredient_id): (total_amount, recipe_count)
+            for user_id, ingredient_id, total_amount, recipe_count
+            in ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id',
+                'total_amount', 'recipe_count').iterator()
+        }
+        mismatches = {
+            key for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        }
+        if mismatches:
+            raise CommandError(
+                f'{len(mismatches)} shopping list rows are out of date '
+                f'for {len({user_id for user_id, _ in mismatches})} users')
+        self.stdout.write(self.style.SUCCESS(
+            f'All {len(stored)} shopping list rows are up to date'))
+
+    @transaction.atomic
+    def rebuild(self, batch_size):
+        ShoppingListItem.objects.all().delete()
+        created = 0
+        batch = []
+        for user_id, ingredient_id, total_amount, recipe_count in (
+                ShoppingListItem.objects.expected().iterator()):
+            batch.append(ShoppingListItem(user_id=user_id,
+                                          ingredient_id=ingredient_id,
+                                          total_amount=total_amount,
+                                          recipe_count=recipe_count))
+            if len(batch) >= batch_size:
+                created += len(ShoppingListItem.objects.bulk_create(batch))
+                batch = []
+        created += len(ShoppingListItem.objects.bulk_create(batch))
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {created} shopping list rows'))
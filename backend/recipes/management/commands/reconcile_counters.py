@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from ...counters import COUNTERS, actual_count
+
+
+class Command(BaseCommand):
+    help = 'Recalculates denormalised counters that have drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report stale counters',
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        for model, field, related_model, related_field in COUNTERS:
+            actual = actual_count(related_model, related_field)
+            stale = model.objects.annotate(actual=actual).exclude(
+                **{field: F('actual')})
+            if options['dry_run']:
+                fixed = stale.count()
+            else:
+                fixed = model.objects.filter(
+                    pk__in=stale.values('pk')).update(**{field: actual})
+            self.stdout.write(
+                f'{model.__name__}.{field}: {fixed} stale')
+        self.stdout.write(self.style.SUCCESS('Counters reconciled'))
@@ -0,0 +1,87 @@
+# Generated by Django 5.2 on 2026-10-18 03:36
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+COUNTERS = (
+    ("User", "recipes_count", "Recipe", "author"),
+    ("User", "subscription_count", "Subscription", "user"),
+    ("User", "follower_count", "Subscription", "author"),
+    ("Recipe", "favorites_count", "Favorite", "recipe"),
+    ("Recipe", "cart_count", "ShoppingCart", "recipe"),
+    ("Ingredient", "recipes_count", "IngredientInRecipe", "ingredient"),
+)
+
+
+def populate_counters(apps, schema_editor):
+    for model_name, field, related_model_name, related_field in COUNTERS:
+        related_model = apps.get_model("recipes", related_model_name)
+        apps.get_model("recipes", model_name).objects.update(
+            **{
+                field: Coalesce(
+                    Subquery(
+                        related_model.objects.filter(**{related_field: OuterRef("pk")})
+                        .order_by()
+                        .values(related_field)
+                        .annotate(count=Count("pk"))
+                        .values("count")
+                    ),
+                    0,
+                )
+            }
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("recipes", "0002_shoppinglistitem"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ingredient",
+            name="recipes_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Рецептов"
+            ),
+        ),
+        migrations.AddField(
+            model_name="recipe",
+            name="cart_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Добавлено в списки покупок"
+            ),
+        ),
+        migrations.AddField(
+            model_name="recipe",
+            name="favorites_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Добавлено в избранное"
+            ),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="follower_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Подписчиков"
+            ),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="recipes_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Рецептов"
+            ),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="subscription_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Подписок"
+            ),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("recipes", "0008_feedentry"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="recipe",
+            index=models.Index(fields=["updated_at"], name="recipe_updated_at_idx"),
+        ),
+    ]
@@ -1,10 +1,35 @@
-from django.db import models
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models
+from django.db.models.functions import RowNumber
 from django.core.validators import MinValueValidator
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import RegexValidator
 
+from .bulk import insert_returning
 
-class User(AbstractUser):
+
+class CounterFieldsMixin:
+    """Leave the denormalised counters out of full saves of existing rows.
+
+    Counters only change through F() updates. An instance loaded before
+    one of them changed, such as a request.user from the token cache,
+    would otherwise write its stale copy back.
+    """
+
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')
+                and not self._state.adding and self.pk is not None):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+
+class User(CounterFieldsMixin, AbstractUser):
     email = models.EmailField(
         verbose_name='Адрес электронной почты',
         max_length=254,
@@ -39,9 +64,35 @@ class User(AbstractUser):
         null=True,
         blank=True
     )
+    avatar_variants = models.JSONField(
+        verbose_name='Размеры аватара',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Рецептов',
+        default=0,
+        editable=False,
+    )
+    subscription_count = models.PositiveIntegerField(
+        verbose_name='Подписок',
+        default=0,
+        editable=False,
+    )
+    follower_count = models.PositiveIntegerField(
+        verbose_name='Подписчиков',
+        default=0,
+        editable=False,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Изменён',
+        auto_now=True,
+    )
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
+    counter_fields = ('recipes_count', 'subscription_count', 'follower_count')
 
     class Meta:
         verbose_name = 'Пользователь'
@@ -80,7 +131,7 @@ class Subscription(models.Model):
         return f'{self.user.username} подписан на {self.author.username}'
 
 
-class Ingredient(models.Model):
+class Ingredient(CounterFieldsMixin, models.Model):
     name = models.CharField(
         max_length=128,
         verbose_name='Название'
@@ -89,6 +140,17 @@ class Ingredient(models.Model):
         max_length=64,
         verbose_name='Единица измерения'
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Рецептов',
+        default=0,
+        editable=False,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Изменён',
+        auto_now=True,
+    )
+
+    counter_fields = ('recipes_count',)
 
     class Meta:
         verbose_name = 'Продукт'
@@ -100,6 +162,13 @@ class Ingredient(models.Model):
                 name='unique_ingredient_name_unit'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['name'],
+                name='ingredient_name_prefix_idx',
+                opclasses=['varchar_pattern_ops']
+            )
+        ]
 
     def __str__(self):
         return self.name
@@ -136,7 +205,15 @@ class IngredientInRecipe(models.Model):
         return f'{self.ingredient.name} ({self.amount})'
 
 
-class Recipe(models.Model):
+SEARCH_CONFIG = 'russian'
+
+
+def recipe_search_vector():
+    return (SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('text', weight='B', config=SEARCH_CONFIG))
+
+
+class Recipe(CounterFieldsMixin, models.Model):
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -154,6 +231,12 @@ class Recipe(models.Model):
         null=False,
         blank=False
     )
+    image_variants = models.JSONField(
+        verbose_name='Размеры изображения',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     text = models.TextField(
         verbose_name='Описание'
     )
@@ -168,16 +251,55 @@ class Recipe(models.Model):
         related_name='recipes',
         verbose_name='Ингредиенты'
     )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='Добавлено в избранное',
+        default=0,
+        editable=False,
+    )
+    cart_count = models.PositiveIntegerField(
+        verbose_name='Добавлено в списки покупок',
+        default=0,
+        editable=False,
+    )
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Изменён',
+        auto_now=True,
+    )
+
+    counter_fields = ('favorites_count', 'cart_count')
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ['name']
         default_related_name = 'recipes'
+        indexes = [
+            models.Index(
+                fields=['author', '-id'],
+                name='recipe_author_id_idx'
+            ),
+            models.Index(
+                fields=['updated_at'],
+                name='recipe_updated_at_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if (connection.vendor == 'postgresql'
+                and (update_fields is None
+                     or {'name', 'text'} & set(update_fields))):
+            Recipe.objects.filter(pk=self.pk).update(
+                search_vector=recipe_search_vector())
+
 
 class UserRecipeRelation(models.Model):
     user = models.ForeignKey(
@@ -205,6 +327,8 @@ class UserRecipeRelation(models.Model):
 
 
 class Favorite(UserRecipeRelation):
+    counter_field = 'favorites_count'
+
     class Meta(UserRecipeRelation.Meta):
         verbose_name = 'Избранное'
         verbose_name_plural = 'Избранные'
@@ -212,7 +336,228 @@ class Favorite(UserRecipeRelation):
 
 
 class ShoppingCart(UserRecipeRelation):
+    counter_field = 'cart_count'
+
     class Meta(UserRecipeRelation.Meta):
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Списки покупок'
         default_related_name = 'shopping_carts'
+
+
+# Rows per INSERT statement, four parameters each.
+UPSERT_BATCH_SIZE = 250
+
+
+class ShoppingListItemManager(models.Manager):
+    def recipe_deltas(self, recipe_ids, sign=1):
+        return {
+            ingredient_id: (sign * amount, sign * count)
+            for ingredient_id, amount, count in IngredientInRecipe.objects
+            .filter(recipe_id__in=recipe_ids)
+            .values('ingredient_id')
+            .annotate(amount=models.Sum('amount'),
+                      count=models.Count('id'))
+            .values_list('ingredient_id', 'amount', 'count')
+        }
+
+    def add_recipes(self, user_ids, recipe_ids):
+        self.apply_deltas(user_ids, self.recipe_deltas(recipe_ids))
+
+    def remove_recipes(self, user_ids, recipe_ids):
+        self.apply_deltas(user_ids, self.recipe_deltas(recipe_ids, sign=-1))
+
+    def apply_deltas(self, user_ids, deltas):
+        """Add (amount, recipe_count) deltas per ingredient for every user.
+
+        Deltas adding a recipe are upserted, so a row inserted by a
+        concurrent transaction at any point still gets them. The others
+        shift rows that exist already with a single UPDATE, and rows no
+        longer backed by any recipe are removed.
+        """
+        user_ids = list(user_ids)
+        if not user_ids or not deltas:
+            return
+
+        shifts = {ingredient_id: delta
+                  for ingredient_id, delta in deltas.items() if delta[1] <= 0}
+        if shifts:
+            self.filter(user_id__in=user_ids,
+                        ingredient_id__in=shifts).update(
+                total_amount=models.F('total_amount') + models.Case(
+                    *[models.When(ingredient_id=ingredient_id, then=amount)
+                      for ingredient_id, (amount, _) in shifts.items()],
+                    default=0),
+                recipe_count=models.F('recipe_count') + models.Case(
+                    *[models.When(ingredient_id=ingredient_id, then=count)
+                      for ingredient_id, (_, count) in shifts.items()],
+                    default=0),
+            )
+        self.insert_or_add([
+            (user_id, ingredient_id, amount, count)
+            for user_id in user_ids
+            for ingredient_id, (amount, count) in deltas.items()
+            if count > 0
+        ])
+        self.filter(user_id__in=user_ids, recipe_count__lte=0).delete()
+
+    def insert_or_add(self, rows):
+        """Insert (user_id, ingredient_id, amount, count) rows.
+
+        Rows that exist already, including ones a concurrent transaction
+        just committed, get the amounts added instead (INSERT ... ON
+        CONFLICT DO UPDATE).
+        """
+        quote = connection.ops.quote_name
+        meta = self.model._meta
+        table = quote(meta.db_table)
+        user, ingredient, amount, count = (
+            quote(meta.get_field(name).column)
+            for name in ('user', 'ingredient', 'total_amount',
+                         'recipe_count'))
+        columns = ', '.join((user, ingredient, amount, count))
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+                batch = rows[start:start + UPSERT_BATCH_SIZE]
+                values = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+                cursor.execute(
+                    f'INSERT INTO {table} ({columns}) VALUES {values} '
+                    f'ON CONFLICT ({user}, {ingredient}) DO UPDATE SET '
+                    f'{amount} = {table}.{amount} + EXCLUDED.{amount}, '
+                    f'{count} = {table}.{count} + EXCLUDED.{count}',
+                    [value for row in batch for value in row])
+
+    def expected(self, user_ids=None):
+        """Aggregate the shopping lists from scratch."""
+        ingredients = IngredientInRecipe.objects.filter(
+            recipe__shopping_carts__isnull=False)
+        if user_ids is not None:
+            ingredients = ingredients.filter(
+                recipe__shopping_carts__user_id__in=user_ids)
+        return ingredients.values(
+            'ingredient_id',
+            user_id=models.F('recipe__shopping_carts__user_id'),
+        ).annotate(
+            total_amount=models.Sum('amount'),
+            recipe_count=models.Count('id'),
+        ).values_list('user_id', 'ingredient_id',
+                      'total_amount', 'recipe_count')
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_items',
+        verbose_name='Продукт'
+    )
+    total_amount = models.PositiveIntegerField(
+        verbose_name='Общая мера',
+    )
+    recipe_count = models.PositiveIntegerField(
+        verbose_name='Рецептов',
+    )
+
+    objects = ShoppingListItemManager()
+
+    class Meta:
+        verbose_name = 'Продукт в списке покупок'
+        verbose_name_plural = 'Продукты в списке покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_shopping_list_item'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} — {self.ingredient.name}'
+
+
+class FeedEntryManager(models.Manager):
+    def fan_out(self, recipe_id, author_id, batch_size):
+        """Add a recipe to the feeds of the author's followers.
+
+        Followers are read and inserted batch_size at a time, so authors
+        with many followers do not hold one huge statement.
+        """
+        followers = Subscription.objects.filter(
+            author_id=author_id).order_by('user_id').values_list(
+                'user_id', flat=True)
+        created = 0
+        last_user_id = 0
+        while True:
+            batch = list(followers.filter(
+                user_id__gt=last_user_id)[:batch_size])
+            if not batch:
+                return created
+            created += len(insert_returning(
+                FeedEntry, ['user_id', 'recipe_id'],
+                [(user_id, recipe_id) for user_id in batch], 'user_id'))
+            last_user_id = batch[-1]
+
+    def backfill(self, user_id, author_ids, limit):
+        """Add the latest recipes of newly followed authors to a feed."""
+        recipe_ids = Recipe.objects.filter(author_id__in=author_ids).annotate(
+            row_number=models.Window(
+                RowNumber(),
+                partition_by=models.F('author_id'),
+                order_by=models.F('id').desc(),
+            )).filter(row_number__lte=limit).values_list('id', flat=True)
+        self.bulk_create(
+            [FeedEntry(user_id=user_id, recipe_id=recipe_id)
+             for recipe_id in recipe_ids],
+            ignore_conflicts=True)
+
+    def remove_authors(self, user_id, author_ids):
+        self.filter(user_id=user_id,
+                    recipe__author_id__in=author_ids).delete()
+
+    def expected(self, max_followers):
+        """(user_id, recipe_id) of every feed entry, from scratch."""
+        return Recipe.objects.filter(
+            author__follower_count__lt=max_followers,
+            author__authors__isnull=False,
+        ).values_list('author__authors__user_id', 'id')
+
+
+class FeedEntry(models.Model):
+    """A recipe of a followed author in a user's feed.
+
+    Recipes of authors with at least FEED['FANOUT_MAX_FOLLOWERS']
+    followers are not copied here but read at request time, see
+    api.feed.
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed',
+        verbose_name='Пользователь'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт'
+    )
+
+    objects = FeedEntryManager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_entry'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} — {self.recipe.name}'
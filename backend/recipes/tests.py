@@ -1,3 +1,127 @@
+from unittest import mock
+
+from django.db.models import F
 from django.test import TestCase
 
-# Create your tests here.
+from .filters import cooking_time_terciles
+from .models import (Favorite, Ingredient, Recipe, ShoppingListItem,
+                     ShoppingListItemManager, Subscription, User)
+
+
+class ShoppingListItemManagerTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='cook', email='cook@example.com', first_name='Анна',
+            last_name='Иванова', password='password')
+        cls.flour = Ingredient.objects.create(name='мука',
+                                              measurement_unit='г')
+        cls.milk = Ingredient.objects.create(name='молоко',
+                                             measurement_unit='мл')
+
+    def get_list(self):
+        return dict(ShoppingListItem.objects.filter(
+            user=self.user).values_list('ingredient_id', 'total_amount'))
+
+    def test_apply_deltas_inserts_shifts_and_removes(self):
+        apply_deltas = ShoppingListItem.objects.apply_deltas
+        apply_deltas([self.user.pk], {self.flour.pk: (200, 1)})
+        apply_deltas([self.user.pk], {self.flour.pk: (100, 1),
+                                      self.milk.pk: (50, 1)})
+        self.assertEqual(self.get_list(),
+                         {self.flour.pk: 300, self.milk.pk: 50})
+        apply_deltas([self.user.pk], {self.milk.pk: (-50, -1)})
+        self.assertEqual(self.get_list(), {self.flour.pk: 300})
+
+    def test_concurrent_add_of_a_missing_row(self):
+        # Another cart add commits the row after this one's UPDATE ran
+        # and before its insert; the insert must add to that row.
+        insert_or_add = ShoppingListItemManager.insert_or_add
+
+        def concurrent_insert(manager, rows):
+            ShoppingListItem.objects.create(
+                user=self.user, ingredient=self.flour, total_amount=200,
+                recipe_count=1)
+            return insert_or_add(manager, rows)
+
+        with mock.patch.object(ShoppingListItemManager, 'insert_or_add',
+                               autospec=True, side_effect=concurrent_insert):
+            ShoppingListItem.objects.apply_deltas(
+                [self.user.pk], {self.flour.pk: (100, 1)})
+
+        item = ShoppingListItem.objects.get(user=self.user)
+        self.assertEqual((item.total_amount, item.recipe_count), (300, 2))
+
+
+class CookingTimeTercilesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password')
+
+    def create_recipes(self, *cooking_times):
+        Recipe.objects.bulk_create(
+            Recipe(author=self.author, name=f'Рецепт {number}',
+                   image='recipes/images/recipe.png', text='Описание',
+                   cooking_time=cooking_time)
+            for number, cooking_time in enumerate(cooking_times))
+
+    def test_too_few_distinct_times(self):
+        self.create_recipes(10, 10, 20)
+        self.assertIsNone(cooking_time_terciles())
+
+    def test_thresholds_at_one_and_two_thirds(self):
+        self.create_recipes(10, 20, 30, 30)
+        self.assertEqual(cooking_time_terciles(), (20, 30))
+        self.create_recipes(40, 50, 60)
+        self.assertEqual(cooking_time_terciles(), (30, 50))
+
+
+class CounterTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@example.com',
+            first_name='Пётр', last_name='Петров', password='password')
+        cls.reader = User.objects.create_user(
+            username='reader', email='reader@example.com',
+            first_name='Анна', last_name='Иванова', password='password')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='Рецепт',
+            image='recipes/images/recipe.png', text='Описание',
+            cooking_time=10)
+
+    def test_full_save_keeps_counters(self):
+        stale = User.objects.get(pk=self.reader.pk)
+        User.objects.filter(pk=self.reader.pk).update(
+            subscription_count=F('subscription_count') + 1)
+        stale.first_name = 'Мария'
+        stale.save()
+        self.reader.refresh_from_db()
+        self.assertEqual((self.reader.first_name,
+                          self.reader.subscription_count), ('Мария', 1))
+
+    def test_deleting_a_user_recounts_related_counters(self):
+        Subscription.objects.create(user=self.reader, author=self.author)
+        Favorite.objects.create(user=self.reader, recipe=self.recipe)
+        User.objects.filter(pk=self.author.pk).update(follower_count=1)
+        Recipe.objects.filter(pk=self.recipe.pk).update(favorites_count=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reader.delete()
+        self.author.refresh_from_db()
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.author.follower_count, 0)
+        self.assertEqual(self.recipe.favorites_count, 0)
+
+    def test_deleting_a_recipe_recounts_author_and_ingredients(self):
+        flour = Ingredient.objects.create(name='мука', measurement_unit='г',
+                                          recipes_count=1)
+        self.recipe.ingredients_in_recipe.create(ingredient=flour, amount=1)
+        User.objects.filter(pk=self.author.pk).update(recipes_count=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.delete()
+        self.author.refresh_from_db()
+        flour.refresh_from_db()
+        self.assertEqual((self.author.recipes_count, flour.recipes_count),
+                         (0, 0))